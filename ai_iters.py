@@ -4,19 +4,37 @@ import multiprocessing
 import click
 
 import core
-from factory import player_factory, serializer_factory
+import opening_book
+from factory import game_factory, player_factory, serializer_factory
 
 
-def play(i, format, ai, db):
+def play(i, format, ai, db, engine, key_format, canonical, verify, book_path,
+         max_states=None, eviction="lru", flush_states=None,
+         flush_seconds=None):
     print("Playing game %d" % i)
     print(datetime.datetime.now())
-    with serializer_factory.get_serializer(format, db=db) as tree:
-        x = player_factory.get_player(ai, "x", tree=tree)
-        o = player_factory.get_player(ai, "o", tree=tree)
+    engine = game_factory.get_engine(engine)
+    tree_kwargs = {"db": db, "key_format": key_format, "canonical": canonical,
+                   "verify": verify}
+    if max_states:
+        tree_kwargs.update(max_states=max_states, eviction=eviction)
+    if flush_states:
+        tree_kwargs["flush_states"] = flush_states
+    if flush_seconds:
+        tree_kwargs["flush_seconds"] = flush_seconds
+    with serializer_factory.get_serializer(format, **tree_kwargs) as tree:
+        player_kwargs = {"tree": tree, "engine": engine}
+        if book_path:
+            player_kwargs["book"] = opening_book.OpeningBook(book_path)
+            player_kwargs["book"].load()
+        x = player_factory.get_player(ai, "x", **player_kwargs)
+        o = player_factory.get_player(ai, "o", **player_kwargs)
         players = [x, o]
-        game = core.Game(players)
+        game = engine(players)
         for turn in game.play():
             pass
+        if book_path:
+            player_kwargs["book"].save()
 
 
 @click.command()
@@ -25,8 +43,31 @@ def play(i, format, ai, db):
 @click.option("--ai", default=None)
 @click.option("--db", default=None)
 @click.option("--processes", "-p", default=1)
-def main(n, format, ai, db, processes):
-    args = [(i, format, ai, db) for i in range(n)]
+@click.option("--engine", "-e", "engine", default="core",
+              type=click.Choice(["core", "bitboard"]))
+@click.option("--keys", "key_format", default="string",
+              type=click.Choice(["string", "int", "bytes", "zobrist"]))
+@click.option("--canonical", is_flag=True,
+              help="Share tree entries between symmetric states.")
+@click.option("--verify", is_flag=True,
+              help="Check zobrist keys for hash collisions between recent "
+                   "states of each process.")
+@click.option("--book", "book_path", default=None,
+              help="Opening book file for the setups of mcts players.")
+@click.option("--max-states", "max_states", type=int, default=None,
+              help="States held in memory by the tree (not mongo or json).")
+@click.option("--eviction", default="lru", type=click.Choice(["lru", "visits"]),
+              help="States evicted first beyond --max-states.")
+@click.option("--flush-states", "flush_states", type=int, default=None,
+              help="Buffered states written by mongo_bulk (in the background) "
+                   "and sql trees.")
+@click.option("--flush-seconds", "flush_seconds", type=float, default=None,
+              help="Seconds between background writes of mongo_bulk.")
+def main(n, format, ai, db, processes, engine, key_format, canonical, verify,
+         book_path, max_states, eviction, flush_states, flush_seconds):
+    args = [(i, format, ai, db, engine, key_format, canonical, verify,
+             book_path, max_states, eviction, flush_states, flush_seconds)
+            for i in range(n)]
     if processes == 1:
         for arg in args:
             play(*arg)
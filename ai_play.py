@@ -1,21 +1,29 @@
 import math
+import multiprocessing
 import random
+import time
 import collections
 import numpy as np
 
+import batch_sim
 import cnn
-from core import Game, Player, InvalidPlayError
+import mcts
+import shared_tree
+from core import Game, Player
 from serialize import Tree
 
 
 C = math.sqrt(2)  # Exploration parameter.
 E = 0.05  # Epsilon greedy exploration parameter.
 PLAYOUTS = 500  # Simulation playouts for Monte Carlo Tree Search.
+ROUNDS = 8  # Rounds of worker searches checked for an early stop.
 
 
 class AIPlayer(Player):
-    def __init__(self, name, pawns=None, tree=Tree(), lazy=False, debug=False):
+    def __init__(self, name, pawns=None, tree=Tree(), lazy=False, debug=False,
+                 engine=Game):
         self.tree = tree
+        self.engine = engine
         self.lazy = lazy
         self.debug = debug
         super().__init__(name, pawns=pawns)
@@ -31,16 +39,21 @@ class AIPlayer(Player):
         else:
             options = super().turn_options(game)
         if self.debug:
-            for new_state, winner in options:
-                game.set_state(new_state)
-                game.print_state()
-                try:
-                    print(self.tree.dict[new_state])
-                except KeyError:
-                    print("No dict info")
-            game.set_state(state)
+            self.print_options(game, options)
         return options
 
+    def print_options(self, game, options):
+        """Print each option of game with its record in the tree."""
+        state = game.compact_state()
+        for new_state, winner in options:
+            game.set_state(new_state)
+            game.print_state()
+            try:
+                print(self.tree[new_state])
+            except KeyError:
+                print("No dict info")
+        game.set_state(state)
+
     def select_func(self, options):
         states = []
         values = []
@@ -50,24 +63,30 @@ class AIPlayer(Player):
             states.append(state)
         return self.policy_func(states)
 
+    def record_value(self, record):
+        """Win probability of a tree record, None if untried."""
+        val = None
+        if record and record["tries"]:
+            val = record["wins"]/record["tries"]
+        return val
+
     def value_func(self, state):
         """Win probability."""
-        val = None
         try:
-            n = self.tree[state]["tries"]
-            w = self.tree[state]["wins"]
-            if n:
-                val = w/n
+            return self.record_value(self.tree[state])
         except KeyError:
-            pass
-        return val
+            return None
+
+    def values_func(self, states):
+        """Win probabilities of states, looked up in one tree query."""
+        return [self.record_value(record)
+                for record in self.tree.get_many(states)]
 
     def policy_func(self, states):
         """Greedy."""
         max_val = 0
         selection = states[0]
-        for state in states:
-            val = self.value_func(state)
+        for state, val in zip(states, self.values_func(states)):
             if val and (val > max_val):
                 selection = state
                 max_val = val
@@ -75,38 +94,37 @@ class AIPlayer(Player):
 
 
 class RandomPlayer(AIPlayer):
+    def __init__(self, name, win_check=False, **kwargs):
+        self.win_check = win_check
+        super().__init__(name, **kwargs)
+
     def setup(self, game):
-        for pawn in self.pawns:
-            self.active_pawn = pawn
-            choices = pawn.placement_options(game)
-            space = random.choice(choices)
-            self.place(space)
+        game.random_setup(self)
 
     def turn(self, game):
-        pawns = list(self.pawns).copy()
-        random.shuffle(pawns)
-        for pawn in pawns:
-            self.active_pawn = pawn
-            spaces = game.board.copy()
-            random.shuffle(spaces)
-            moved = False
-            for move_space in spaces:
-                try:
-                    self.move(move_space)
-                    if self.winner:
-                        return
-                    moved = True
-                    break
-                except InvalidPlayError:
-                    pass
-            if moved:
-                for build_space in spaces:
-                    try:
-                        self.build(build_space)
-                        return
-                    except InvalidPlayError:
-                        pass
-        game.turns.remove(self)
+        actions = game.legal_actions(self)
+        if not actions:
+            game.turns.remove(self)
+            return
+        if self.win_check:
+            actions = self.checked_actions(game, actions)
+        game.apply(random.choice(actions), self)
+
+    def checked_actions(self, game, actions):
+        """Winning actions, else actions stopping the next player's win."""
+        wins = [action for action in actions if action[2] is None]
+        if wins:
+            return wins
+        opponent = game.turns[1]
+        if not game.has_winning_move(opponent):
+            return actions
+        blocks = []
+        for action in actions:
+            game.apply(action, self)
+            if not game.has_winning_move(opponent):
+                blocks.append(action)
+            game.undo()
+        return blocks or actions
 
 
 class EpsilonGreedyPlayer(AIPlayer):
@@ -133,10 +151,10 @@ class UCTPlayer(AIPlayer):
         selection = None
         state_dict = {}
         untried_states = []
-        for state in states:
-            val = self.value_func(state)
+        for state, record in zip(states, self.tree.get_many(states)):
+            val = self.record_value(record)
             if val:
-                n = self.tree[state]["tries"]
+                n = record["tries"]
                 total += n
                 state_dict[state] = {"val": val, "n": n}
             else:
@@ -157,81 +175,574 @@ class UCTPlayer(AIPlayer):
 
 
 class MCTSPlayer(AIPlayer):
-    def __init__(self, name, c=C, playouts=PLAYOUTS, **kwargs):
+    def __init__(self, name, c=C, playouts=PLAYOUTS, batch_size=None,
+                 win_check=False, book=None, reuse=True, workers=1,
+                 tree_parallel=False, time_limit=None, node_limit=None,
+                 early_stop=False, **kwargs):
+        if playouts is None and not time_limit and not node_limit:
+            raise ValueError("Search needs a playouts, time or node limit")
+        if kwargs.get("lazy"):
+            raise ValueError("MCTS players search their options, "
+                             "lazy is unsupported")
         self.c = c
         self.playouts = playouts
+        self.time_limit = time_limit
+        self.node_limit = node_limit
+        self.early_stop = early_stop
+        self.search_stats = {}
+        self.batch_size = batch_size
+        self.win_check = win_check
+        self.book = book
+        self.sim_games = {}
+        self.reuse = reuse
+        self.workers = workers
+        self.tree_parallel = tree_parallel
+        self.pool = None
+        self.locks = None
+        self.root = None
+        self.selection = None
+        self.reused_playouts = 0
         super().__init__(name, **kwargs)
 
-    def tree_sim(self, state, player_names):
-        players = []
-        for name in player_names:
-            players.append(UCTPlayer(name, tree=self.tree, c=self.c))
-        game = Game(players)
-        game.set_state(state)
-        for player in game.play():
-            yield game
+    def sim_game(self, player_class, player_names, **kwargs):
+        """Simulation game of the named players, reused between playouts."""
+        key = (player_class, tuple(player_names))
+        try:
+            return self.sim_games[key]
+        except KeyError:
+            pass
+        players = [player_class(name, tree=self.tree, **kwargs)
+                   for name in player_names]
+        game = self.engine(players)
+        self.sim_games[key] = game
+        return game
+
+    def expand(self, node):
+        """Expand node with the options of the player to move."""
+        game = self.sim_game(RandomPlayer, node.player_names,
+                             win_check=self.win_check)
+        game.restart(node.state)
+        if node.moved:
+            game.next_player()
+        player = game.active_player()
+        if game.setup_check(player):
+            options = game.turn_options(player)
+        else:
+            options = game.setup_options(player)
+        node.expand(options, [player.name for player in game.turns],
+                    self.tree)
+
+    def select_child(self, node):
+        return node.select_uct(self.c)
 
     def random_sim(self, state, player_names):
-        players = []
-        for name in player_names:
-            players.append(RandomPlayer(name, tree=self.tree))
-        game = Game(players)
-        game.set_state(state)
+        game = self.sim_game(RandomPlayer, player_names,
+                             win_check=self.win_check)
+        game.restart(state)
         game.next_player()
         for player in game.play():
             pass
         return game.winner().name
 
+    def leaf_sims(self, leaves):
+        """Winner names of random playouts from leaves.
+
+        Leaves are (winner name, state, player names) tuples, with a state
+        and the player names in turn order only for undecided leaves. With a
+        batch_size, all undecided leaves are played out in one vectorized
+        batch_sim call.
+        """
+        winner_names = [winner_name for winner_name, _, _ in leaves]
+        undecided = [i for i, leaf in enumerate(leaves) if leaf[1]]
+        if not self.batch_size:
+            for i in undecided:
+                _, state, player_names = leaves[i]
+                winner_names[i] = self.random_sim(state, player_names)
+        elif undecided:
+            states = [leaves[i][1] for i in undecided]
+            # the player numbered 2 in a leaf state moves next
+            winners = batch_sim.simulate(states, to_move=1)
+            for i, winner in zip(undecided, winners):
+                if winner >= 0:
+                    winner_names[i] = leaves[i][2][winner]
+        return winner_names
+
+    def needs_evaluation(self, node):
+        """Whether selecting an option of node waits for evaluate."""
+        return False
+
+    def evaluate(self, nodes):
+        pass
+
+    def descent(self, node):
+        """Select options from node down to an untried option or a game end.
+
+        Yield the nodes that need evaluation before selecting their options.
+        Return the (node, option index) path and the leaf, as taken by
+        leaf_sims.
+        """
+        path = []
+        while True:
+            node.visits += 1
+            if not node.expanded():
+                self.expand(node)
+            if not node.states:
+                # the player to move is out, with two players the other wins
+                names = node.child_names
+                return path, (names[1] if len(names) == 2 else None, None, None)
+            i = node.win
+            if i is None:
+                if self.needs_evaluation(node):
+                    yield node
+                i = self.select_child(node)
+            path.append((node, i))
+            node.tries[i] += 1
+            if node.winners[i]:
+                return path, (node.child_names[0], None, None)
+            if node.tries[i] == 1:
+                return path, (None, node.states[i], node.child_names)
+            node = node.child(i)
+
+    def descend_batch(self, node, n):
+        """Paths and leaves of n descents from node.
+
+        Descents run until they need evaluation, then the nodes they wait
+        on are evaluated together.
+        """
+        descents = [self.descent(node) for _ in range(n)]
+        results = [None]*n
+        active = list(range(n))
+        while active:
+            waiting = []
+            nodes = []
+            for k in active:
+                try:
+                    nodes.append(next(descents[k]))
+                    waiting.append(k)
+                except StopIteration as stop:
+                    results[k] = stop.value
+            if nodes:
+                self.evaluate(nodes)
+            active = waiting
+        return results
+
+    def descend(self, node):
+        return self.descend_batch(node, 1)[0]
+
+    def reused_root(self, state, player_names, players=()):
+        """Node of state kept from the last search, or None.
+
+        The node is found under the option selected after the last search,
+        among the replies of the next player, or under the reply selected by
+        the search of another player among players with the same
+        search_config, so that statistics of different searches are not
+        mixed. The searches rarely descend into a reply twice, which creates
+        its node, so the reply an opponent searched usually holds far more
+        playouts. The node with the most visits is kept.
+        """
+        nodes = []
+        if self.root is not None and self.selection is not None:
+            child = self.root.find_child(self.selection)
+            if child is not None and child.expanded():
+                reply = mcts.renumber(state, player_names, child.child_names)
+                nodes.append(child.find_child(reply))
+        for player in players:
+            if (player is self or not isinstance(player, MCTSPlayer)
+                    or player.root is None or player.selection is None
+                    or player.search_config() != self.search_config()):
+                continue
+            node = player.root.find_child(player.selection)
+            if node is not None and node.state == mcts.renumber(
+                    state, player_names, node.player_names):
+                nodes.append(node)
+        nodes = [node for node in nodes if node is not None]
+        return max(nodes, key=lambda node: node.visits, default=None)
+
+    def search_config(self):
+        """The settings the statistics of a search depend on."""
+        return (type(self), self.c, self.playouts, self.time_limit,
+                self.node_limit, self.early_stop, self.batch_size,
+                self.win_check, self.engine)
+
     def search(self, game):
-        orig_state = game.compact_state()
-        orig_player_names = [player.name for player in game.turns]
-        # simulate playouts
-        for _ in range(self.playouts):
-            states = []
-            # choose_uct until reaching untried state or end
-            for sim in self.tree_sim(orig_state, orig_player_names):
-                player_name = sim.active_player().name
-                sim_state = sim.compact_state()
-                states.append((player_name, sim_state))
-                self.tree.add_try(sim_state)
-                if self.tree[sim_state]["tries"] == 1:
+        """Run playouts from the position of game, return its options.
+
+        The search stops at the playouts, time_limit (seconds) or node_limit
+        (nodes visited by descents) given, and with early_stop once the
+        greedy choice cannot change anymore, checked between ROUNDS rounds
+        of worker searches. With reuse, the subtree of the position
+        reached since the last search is kept and only playouts beyond those
+        it already holds are run.
+        """
+        start = time.monotonic()
+        state = game.compact_state()
+        player_names = [player.name for player in game.turns]
+        root = None
+        if self.reuse:
+            root = self.reused_root(state, player_names, game.turns)
+        if root is None:
+            root = mcts.Node(state, player_names)
+        self.root = root
+        self.selection = None
+        self.reused_playouts = root.visits
+        if self.debug:
+            print("{:s}: {:d} playouts carried over".format(
+                self.name, self.reused_playouts))
+        if not root.expanded():
+            self.expand(root)
+        playouts = None
+        if self.playouts is not None:
+            playouts = max(self.playouts - self.reused_playouts, 0)
+        deadline = None
+        if self.time_limit:
+            deadline = start + self.time_limit
+        if not root.states:
+            done, depth, nodes = 0, 0, 0
+        elif self.workers > 1 and self.tree_parallel:
+            done, depth, nodes = self.worker_rounds(
+                self.tree_parallel_playouts, root, playouts, deadline,
+                self.node_limit)
+        elif self.workers > 1:
+            done, depth, nodes = self.worker_rounds(
+                self.parallel_playouts, root, playouts, deadline,
+                self.node_limit)
+        else:
+            done, depth, nodes = self.run_playouts(
+                root, playouts, deadline, self.node_limit, self.early_stop)
+        root.export(self.tree)
+        seconds = time.monotonic() - start
+        self.search_stats = {"playouts": done,
+                             "reused": self.reused_playouts,
+                             "depth": depth, "nodes": nodes, "seconds": seconds,
+                             "nodes_per_sec": nodes/seconds if seconds else 0}
+        if self.debug:
+            print("{:s}: {:d} playouts, depth {:d}, {:d} nodes in {:.2f}s "
+                  "({:.0f} nodes/s)".format(self.name, done, depth, nodes,
+                                            seconds,
+                                            self.search_stats["nodes_per_sec"]))
+        return root.options()
+
+    def run_playouts(self, root, playouts=None, deadline=None,
+                     node_limit=None, early_stop=False):
+        """Playouts from root up to the limits given, None for no limit.
+
+        Return the number of playouts, the depth of the deepest descent and
+        the number of nodes visited by descents.
+        """
+        batch_size = self.batch_size or 1
+        start = time.monotonic()
+        done = 0
+        depth = 0
+        nodes = 0
+        # simulate playouts, batch_size at a time
+        while playouts is None or done < playouts:
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                break
+            if node_limit is not None and nodes >= node_limit:
+                break
+            if early_stop and done:
+                # estimate the playouts left within each limit
+                remaining = []
+                if playouts is not None:
+                    remaining.append(playouts - done)
+                if deadline is not None:
+                    remaining.append((deadline - now)*done/(now - start))
+                if node_limit is not None:
+                    remaining.append((node_limit - nodes)*done/max(nodes, 1))
+                if root.settled(min(remaining)):
                     break
+            n = batch_size
+            if playouts is not None:
+                n = min(n, playouts - done)
+            paths = []
+            leaves = []
+            for path, leaf in self.descend_batch(root, n):
+                paths.append(path)
+                leaves.append(leaf)
+                depth = max(depth, len(path))
+                nodes += len(path)
             # if untried state, random playout from leaf
-            winner = sim.winner()
-            if winner:
-                winner_name = winner.name
-            else:
-                sim_player_names = [player.name for player in sim.turns]
-                winner_name = self.random_sim(states[-1][1], sim_player_names)
-            # update tree for all states from root option to leaf
-            for player_name, state in states:
-                if winner_name == player_name:
-                    self.tree.add_win(state)
+            winner_names = self.leaf_sims(leaves)
+            # update statistics of all options from root to leaf
+            for path, winner_name in zip(paths, winner_names):
+                for node, i in path:
+                    if winner_name == node.child_names[0]:
+                        node.wins[i] += 1
+            done += n
+        return done, depth, nodes
+
+    def worker_rounds(self, playout_func, root, playouts=None, deadline=None,
+                      node_limit=None):
+        """Playouts of workers run by playout_func, in rounds with early_stop.
+
+        With early_stop, each round takes a ROUNDS-th of the limits and the
+        search stops once the root is settled for the playouts left.
+        """
+        if not self.early_stop:
+            return playout_func(root, playouts, deadline, node_limit)
+        start = time.monotonic()
+        done = depth = nodes = 0
+        while True:
+            now = time.monotonic()
+            round_playouts = round_node_limit = round_deadline = None
+            remaining = []
+            if playouts is not None:
+                if done >= playouts:
+                    break
+                remaining.append(playouts - done)
+                round_playouts = min(max(-(-playouts // ROUNDS), self.workers),
+                                     playouts - done)
+            if node_limit is not None:
+                if nodes >= node_limit:
+                    break
+                remaining.append((node_limit - nodes)*done/max(nodes, 1))
+                round_node_limit = min(
+                    max(-(-node_limit // ROUNDS), self.workers),
+                    node_limit - nodes)
+            if deadline is not None:
+                if now >= deadline:
+                    break
+                if done:
+                    remaining.append((deadline - now)*done/(now - start))
+                round_deadline = min(deadline,
+                                     now + (deadline - start)/ROUNDS)
+            if done and remaining and root.settled(min(remaining)):
+                break
+            round_done, round_depth, round_nodes = playout_func(
+                root, round_playouts, round_deadline, round_node_limit)
+            if not round_done:
+                break
+            done += round_done
+            depth = max(depth, round_depth)
+            nodes += round_nodes
+        return done, depth, nodes
+
+    def worker_kwargs(self):
+        """Settings of the players searching in worker processes."""
+        return {"c": self.c, "batch_size": self.batch_size,
+                "win_check": self.win_check, "engine": self.engine}
+
+    def worker_pool(self):
+        if self.pool is None:
+            if self.tree_parallel:
+                shared_tree.start_tracker()
+            self.locks = shared_tree.make_locks()
+            self.pool = multiprocessing.Pool(
+                self.workers, initializer=_init_worker,
+                initargs=(type(self), self.worker_kwargs(), self.locks))
+        return self.pool
+
+    def worker_limits(self, playouts, node_limit):
+        """Playouts and node limits of each worker, None for no limit."""
+        limits = []
+        for i in range(self.workers):
+            limit = []
+            for total in (playouts, node_limit):
+                if total is not None:
+                    share, extra = divmod(total, self.workers)
+                    total = share + (i < extra)
+                limit.append(total)
+            limits.append(limit)
+        return limits
+
+    @staticmethod
+    def worker_seconds(deadline):
+        """Seconds left until deadline, None for no deadline.
+
+        Workers get time budgets rather than deadlines, since monotonic
+        clocks of different processes need not share a reference point.
+        """
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0)
+
+    def parallel_playouts(self, root, playouts, deadline=None,
+                          node_limit=None):
+        """Split playouts between workers and add up their root statistics.
+
+        Each worker searches its own tree from root, so only the tries and
+        wins of the root options are shared. Return the totals of
+        run_playouts.
+        """
+        seconds = self.worker_seconds(deadline)
+        args = [(root.state, root.player_names, root.moved, worker_playouts,
+                 seconds, worker_nodes)
+                for worker_playouts, worker_nodes
+                in self.worker_limits(playouts, node_limit)]
+        index = {state: i for i, state in enumerate(root.states)}
+        results = self.worker_pool().starmap(_worker_playouts, args)
+        done = depth = nodes = 0
+        for states, tries, wins, stats in results:
+            for state, n, w in zip(states, tries, wins):
+                root.tries[index[state]] += n
+                root.wins[index[state]] += w
+            done += stats[0]
+            depth = max(depth, stats[1])
+            nodes += stats[2]
+        root.visits += done
+        return done, depth, nodes
+
+    def shared_playouts(self, tree, root, playouts=None, deadline=None,
+                        node_limit=None):
+        """Playouts from root with the statistics of a shared_tree.SharedTree.
+
+        Options carry virtual losses while searches are below them. Return
+        the totals of run_playouts.
+        """
+        keys = {}
+        done = 0
+        depth = 0
+        nodes = 0
+        while playouts is None or done < playouts:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if node_limit is not None and nodes >= node_limit:
+                break
+            node = root
+            path = []
+            while True:
+                if not node.expanded():
+                    self.expand(node)
+                    keys[node] = [tree.encode(state) for state in node.states]
+                if not node.states:
+                    names = node.child_names
+                    leaf = (names[1] if len(names) == 2 else None, None, None)
+                    break
+                i = node.win
+                if i is None:
+                    i = tree.select_uct(keys[node], self.c)
+                first = tree.add_virtual_loss(keys[node][i])
+                path.append((keys[node][i], node.child_names[0]))
+                if node.winners[i]:
+                    leaf = (node.child_names[0], None, None)
+                    break
+                if first:
+                    leaf = (None, node.states[i], node.child_names)
+                    break
+                node = node.child(i)
+            winner_name = self.leaf_sims([leaf])[0]
+            tree.backup([key for key, _ in path],
+                        [winner_name == name for _, name in path])
+            done += 1
+            depth = max(depth, len(path))
+            nodes += len(path)
+        return done, depth, nodes
+
+    def tree_parallel_playouts(self, root, playouts, deadline=None,
+                               node_limit=None):
+        """Split playouts between workers growing one shared tree.
+
+        The shared tree lives for one search and starts from the statistics
+        of the root options. Return the totals of run_playouts.
+        """
+        pool = self.worker_pool()
+        with shared_tree.SharedTree(self.shared_capacity(playouts),
+                                    locks=self.locks) as tree:
+            for state, n, w in zip(root.states, root.tries, root.wins):
+                tree.merge(state, n, w)
+            seconds = self.worker_seconds(deadline)
+            args = [(tree.name, tree.capacity, root.state, root.player_names,
+                     root.moved, worker_playouts, seconds, worker_nodes)
+                    for worker_playouts, worker_nodes
+                    in self.worker_limits(playouts, node_limit)]
+            results = pool.starmap(_worker_shared_playouts, args)
+            for i, state in enumerate(root.states):
+                record = tree[state]
+                root.tries[i] = record["tries"]
+                root.wins[i] = record["wins"]
+        done = sum(stats[0] for stats in results)
+        root.visits += done
+        return (done, max(stats[1] for stats in results),
+                sum(stats[2] for stats in results))
+
+    def shared_capacity(self, playouts):
+        """Slots of the shared tree, a power of two above 8 per playout."""
+        capacity = shared_tree.CAPACITY
+        while playouts is not None and capacity < 8*playouts:
+            capacity *= 2
+        return capacity
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def setup(self, game):
+        state = game.compact_state()
+        if self.book is not None and state in self.book:
+            game.set_state(self.book[state])
+            self.root = None
+            return
+        super().setup(game)
+        if self.book is not None:
+            self.book[state] = game.compact_state()
 
     def setup_options(self, game):
-        self.search(game)
-        return super().setup_options(game)
+        return self.turn_options(game)
 
     def turn_options(self, game):
-        self.search(game)
-        return super().turn_options(game)
+        options = self.search(game)
+        if self.debug:
+            self.print_options(game, options)
+        return options
+
+    def select_func(self, options):
+        self.selection = super().select_func(options)
+        return self.selection
 
     def policy_func(self, states):
         # act greedily
-        return super().policy_func(states)
+        return self.root.greedy(states)
+
+
+_worker = None
+_locks = None
+
+
+def _init_worker(player_class, kwargs, locks):
+    global _worker, _locks
+    _worker = player_class("worker", tree=Tree(), reuse=False, **kwargs)
+    _locks = locks
+
+
+def _worker_deadline(seconds):
+    if seconds is None:
+        return None
+    return time.monotonic() + seconds
+
+
+def _worker_playouts(state, player_names, moved, playouts, seconds,
+                     node_limit):
+    """Root option states, tries and wins of playouts in a worker process.
+
+    Also return the totals of run_playouts.
+    """
+    deadline = _worker_deadline(seconds)
+    root = mcts.Node(state, player_names, moved)
+    _worker.expand(root)
+    stats = _worker.run_playouts(root, playouts, deadline, node_limit)
+    return root.states, root.tries, root.wins, stats
+
+
+def _worker_shared_playouts(name, capacity, state, player_names, moved,
+                            playouts, seconds, node_limit):
+    """Run playouts in a worker process on the shared tree named name."""
+    deadline = _worker_deadline(seconds)
+    root = mcts.Node(state, player_names, moved)
+    with shared_tree.SharedTree(capacity, name=name, locks=_locks) as tree:
+        return _worker.shared_playouts(tree, root, playouts, deadline,
+                                       node_limit)
 
 
 class ThompsonSamplingPlayer(AIPlayer):
-    def value_func(self, state):
+    def record_value(self, record):
         val = None
-        try:
-            n = self.tree[state]["tries"]
-            w = self.tree[state]["wins"]
-            if n:
-                l = n - w
-                val = np.random.beta(w+1, l+1)
-        except KeyError:
-            pass
+        if record and record["tries"]:
+            n = record["tries"]
+            w = record["wins"]
+            l = n - w
+            val = np.random.beta(w+1, l+1)
         return val
 
 
@@ -239,15 +750,14 @@ class CNNPlayer(ThompsonSamplingPlayer):
     def __init__(self, name, model=None, **kwargs):
         self.model = model
         if not self.model:
-            self.model = cnn.load_model()
+            self.model = cnn.ValueCache()
         super().__init__(name, **kwargs)
 
     def policy_func(self, states):
         max_val = 0
         selection = None
         untried_states = []
-        for state in states:
-            val = self.value_func(state)
+        for state, val in zip(states, self.values_func(states)):
             if not val:
                 untried_states.append(state)
             elif val > max_val:
@@ -262,7 +772,7 @@ class UctCnnPlayer(UCTPlayer):
     def __init__(self, name, c=C, model=None, **kwargs):
         self.model = model
         if not self.model:
-            self.model = cnn.load_model()
+            self.model = cnn.ValueCache()
         super().__init__(name, c=c, **kwargs)
 
     def untried_policy(self, states):
@@ -270,17 +780,40 @@ class UctCnnPlayer(UCTPlayer):
 
 
 class MctsCnnPlayer(MCTSPlayer):
+    """MCTS choosing untried options by the value network.
+
+    The options of a node are scored once, and the nodes that descents of a
+    batch wait on are scored together in one forward pass.
+    """
+
     def __init__(self, name, model=None, **kwargs):
         self.model = model
         if not self.model:
-            self.model = cnn.load_model()
+            self.model = cnn.ValueCache()
+        self.queue = cnn.EvalQueue(self.model)
         super().__init__(name, **kwargs)
 
-    def tree_sim(self, state, player_names):
-        players = []
-        for name in player_names:
-            players.append(CNNPlayer(name, tree=self.tree, model=self.model))
-        game = Game(players)
-        game.set_state(state)
-        for player in game.play():
-            yield game
+    def worker_kwargs(self):
+        kwargs = super().worker_kwargs()
+        kwargs["model"] = self.model
+        return kwargs
+
+    def search_config(self):
+        return super().search_config() + (self.model,)
+
+    def needs_evaluation(self, node):
+        return node.priors is None and 0 in node.tries
+
+    def evaluate(self, nodes):
+        nodes = list({id(node): node for node in nodes}.values())
+        tickets = [self.queue.put(node.states) for node in nodes]
+        for node, ticket in zip(nodes, tickets):
+            node.priors = self.queue.result(ticket)
+
+    def select_child(self, node):
+        untried = [i for i, n in enumerate(node.tries) if not n]
+        if untried:
+            return max(untried, key=node.priors.__getitem__)
+        tries = np.array(node.tries)
+        wins = np.array(node.wins)
+        return int(np.random.beta(wins + 1, tries - wins + 1).argmax())
@@ -0,0 +1,139 @@
+"""An in-memory tree with statistics in arrays instead of a dict per state.
+
+Each key is given an integer slot. Tries and wins are columns of growable
+NumPy arrays, indexed by slot, and the options of a slot are packed keys
+(see `codec.py`), each followed by a winner byte, joined into one bytes
+object. Records are built on lookup, so a state costs its key, a slot and two
+counters until it has options. Slots of evicted states are reused.
+"""
+import math
+
+import numpy as np
+
+import codec
+import serialize
+
+
+CAPACITY = 1 << 10
+COUNTER = np.uint32
+
+
+class ArrayTree(serialize.Tree):
+
+    def __init__(self, key_format=None, canonical=False, verify=False,
+                 capacity=CAPACITY, max_states=None, eviction="lru"):
+        super().__init__(key_format=key_format, canonical=canonical,
+                         verify=verify, max_states=max_states,
+                         eviction=eviction)
+        self.tree = None
+        self.slots = {}
+        self.keys = []
+        self.free = []
+        self.tries = np.zeros(capacity, dtype=COUNTER)
+        self.wins = np.zeros(capacity, dtype=COUNTER)
+        self.options = {}
+        self.size = codec.SIZE
+
+    def __len__(self):
+        return len(self.slots)
+
+    def nbytes(self):
+        """Bytes held by the counter arrays and packed options."""
+        return (self.tries.nbytes + self.wins.nbytes
+                + sum(map(len, self.options.values())))
+
+    def _grow(self):
+        capacity = 2*len(self.tries)
+        for name in ("tries", "wins"):
+            column = np.zeros(capacity, dtype=COUNTER)
+            column[:len(self.keys)] = getattr(self, name)[:len(self.keys)]
+            setattr(self, name, column)
+
+    def _record(self, slot):
+        return {"tries": int(self.tries[slot]), "wins": int(self.wins[slot]),
+                "options": self._unpack_options(self.options.get(slot))}
+
+    def _pack_options(self, options):
+        """Join the packed states and winner bytes of (state, winner) options."""
+        self.size = math.isqrt(len(options[0][0]) // 2)
+        return b"".join(codec.pack_bytes(state) + bytes((bool(winner),))
+                        for state, winner in options)
+
+    def _unpack_options(self, packed):
+        if not packed:
+            return []
+        n = codec.key_bytes(self.size)
+        return [(codec.unpack_bytes(packed[i:i + n], self.size),
+                 bool(packed[i + n]))
+                for i in range(0, len(packed), n + 1)]
+
+    def _contains(self, key):
+        return key in self.slots
+
+    def _get(self, key):
+        slot = self.slots[key]
+        self._touch(key)
+        return self._record(slot)
+
+    def _get_many(self, keys):
+        records = []
+        for key in keys:
+            slot = self.slots.get(key)
+            if slot is None:
+                records.append(None)
+            else:
+                self._touch(key)
+                records.append(self._record(slot))
+        return records
+
+    def items(self):
+        for slot, key in enumerate(self.keys):
+            if key is not None:
+                yield self.decode(key), self._record(slot)
+
+    def _resident(self):
+        return self.slots
+
+    def _resident_tries(self, key):
+        return self.tries[self.slots[key]]
+
+    def _evict(self, keys):
+        for key in keys:
+            slot = self.slots.pop(key)
+            self.keys[slot] = None
+            self.tries[slot] = self.wins[slot] = 0
+            self.options.pop(slot, None)
+            self.free.append(slot)
+
+    def _insert(self, key):
+        if key in self.slots:
+            return
+        if self.free:
+            slot = self.free.pop()
+            self.keys[slot] = key
+        else:
+            if len(self.keys) == len(self.tries):
+                self._grow()
+            slot = len(self.keys)
+            self.keys.append(key)
+        self.slots[key] = slot
+        self._check_bound(key)
+
+    def _add_try(self, key):
+        self._touch(key)
+        self.tries[self.slots[key]] += 1
+
+    def _add_win(self, key):
+        self.wins[self.slots[key]] += 1
+
+    def _set_options(self, key, options):
+        slot = self.slots[key]
+        if options:
+            self.options[slot] = self._pack_options(options)
+        else:
+            self.options.pop(slot, None)
+
+    def _merge(self, key, tries, wins):
+        slot = self.slots[key]
+        self.tries[slot] += tries
+        self.wins[slot] += wins
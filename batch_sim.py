@@ -0,0 +1,150 @@
+"""Random playouts of many games at once with NumPy.
+
+Games are kept as arrays: levels (N, cells), pawn positions (N, players,
+pawns) and the player to move (N,). Every step plays one random turn in all
+unfinished games, sampling uniformly among the legal (pawn, move, build)
+actions of each game from a vectorized legal action mask.
+"""
+import numpy as np
+
+import core
+
+
+MAX_PLIES = 500
+
+_tables = {}
+
+
+def padded_neighbors(size):
+    """(cells + 1, 8) neighbor indices padded with the sentinel cell.
+
+    The sentinel cell, numbered cells, always holds a dome, so padding never
+    yields a legal move or build.
+    """
+    try:
+        return _tables[size]
+    except KeyError:
+        pass
+    cells = size**2
+    table = np.full((cells + 1, 8), cells, dtype=np.intp)
+    for cell, neighbors in enumerate(core.neighbor_table(size)):
+        table[cell, :len(neighbors)] = neighbors
+    _tables[size] = table
+    return table
+
+
+def parse_states(states, num_players=2, num_pawns=2):
+    """Levels and pawn positions of compact states.
+
+    Levels get an extra sentinel column holding a dome. Pawn positions are -1
+    for pawns that are not placed yet.
+    """
+    n = len(states)
+    digits = np.frombuffer("".join(states).encode(), dtype=np.uint8)
+    digits = digits.reshape(n, -1) - 48
+    cells = digits.shape[1] // 2
+    levels = np.full((n, cells + 1), 4, dtype=np.int8)
+    levels[:, :cells] = digits[:, :cells]
+    occupants = digits[:, cells:]
+    pawns = np.full((n, num_players, num_pawns), -1, dtype=np.intp)
+    for player in range(num_players):
+        rows, cols = np.nonzero(occupants == player + 1)
+        slots = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        pawns[rows, player, slots] = cols
+    return levels, pawns
+
+
+def random_setup(levels, pawns, to_move, rng):
+    """Place missing pawns at random, the placing player gives up the move."""
+    cells = levels.shape[1] - 1
+    rows = np.nonzero((pawns < 0).any(axis=(1, 2)))[0]
+    for row in rows:
+        placed = pawns[row][pawns[row] >= 0]
+        free = np.setdiff1d(np.arange(cells), placed)
+        missing = pawns[row] < 0
+        pawns[row][missing] = rng.choice(free, size=missing.sum(), replace=False)
+        if missing[to_move[row]].any():
+            to_move[row] = (to_move[row] + 1) % pawns.shape[1]
+
+
+def step(levels, pawns, to_move, neighbors, rng):
+    """Play one random turn in every game, changing levels and pawns.
+
+    Return the winning player per game, -1 for games that go on.
+    """
+    n, num_players, num_pawns = pawns.shape
+    cells = levels.shape[1]
+    rows = np.arange(n)
+    flat_levels = levels.reshape(-1)
+    base = rows * cells
+    occupied = np.zeros(n*cells, dtype=bool)
+    occupied[(base[:, None] + pawns.reshape(n, -1)).reshape(-1)] = True
+
+    start = pawns[rows, to_move]
+    start_level = flat_levels[base[:, None] + start]
+    dest = neighbors[start]
+    flat_dest = base[:, None, None] + dest
+    dest_level = flat_levels[flat_dest]
+    max_level = np.minimum(start_level + 1, 3)[:, :, None]
+    move_ok = ~occupied[flat_dest] & (dest_level <= max_level)
+    win = move_ok & (dest_level == 3) & (start_level < 3)[:, :, None]
+
+    build = neighbors[dest]
+    flat_build = base[:, None, None, None] + build
+    build_ok = ((flat_levels[flat_build] < 4)
+                & (~occupied[flat_build] | (build == start[:, :, None, None])))
+    build_ok &= (move_ok & ~win)[..., None]
+    build_ok[..., 0] |= win
+
+    mask = build_ok.reshape(n, -1)
+    keys = rng.random(mask.shape)
+    keys[~mask] = -1.0
+    action = keys.argmax(axis=1)
+    stuck = ~mask[rows, action]
+    width = neighbors.shape[1]
+    pawn, rest = np.divmod(action, width*width)
+    direction, build_num = np.divmod(rest, width)
+
+    moved = ~stuck
+    pawns[rows[moved], to_move[moved], pawn[moved]] = dest[rows, pawn, direction][moved]
+    won = win[rows, pawn, direction] & moved
+    built = moved & ~won
+    build_cells = flat_build[rows, pawn, direction, build_num]
+    flat_levels[build_cells[built]] += 1
+
+    winners = np.full(n, -1, dtype=np.intp)
+    winners[won] = to_move[won]
+    winners[stuck] = (to_move[stuck] + 1) % num_players
+    return winners
+
+
+def simulate(states, to_move=0, rng=None, max_plies=MAX_PLIES):
+    """Play random games from compact states until every game is decided.
+
+    to_move is the relative number (0 for the player numbered 1 in the
+    states) of the player to move. Return the relative number of the winner
+    of every game, -1 for games still undecided after max_plies turns.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    n = len(states)
+    levels, pawns = parse_states(states)
+    size = int((levels.shape[1] - 1) ** 0.5)
+    neighbors = padded_neighbors(size)
+    players = np.full(n, to_move, dtype=np.intp)
+    random_setup(levels, pawns, players, rng)
+    winners = np.full(n, -1, dtype=np.intp)
+    live = np.arange(n)
+    for _ in range(max_plies):
+        if not len(live):
+            break
+        sub_levels = levels[live]
+        sub_pawns = pawns[live]
+        sub_players = players[live]
+        sub_winners = step(sub_levels, sub_pawns, sub_players, neighbors, rng)
+        levels[live] = sub_levels
+        pawns[live] = sub_pawns
+        winners[live] = sub_winners
+        players[live] = (sub_players + 1) % pawns.shape[1]
+        live = live[sub_winners < 0]
+    return winners
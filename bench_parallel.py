@@ -0,0 +1,58 @@
+import random
+import time
+
+import click
+
+import ai_play
+from factory import game_factory
+
+
+def search_rate(engine, playouts, workers, tree_parallel, state, moves):
+    """Playouts per second of the searches of moves from state."""
+    x = ai_play.MCTSPlayer("x", engine=engine, playouts=playouts,
+                           workers=workers, tree_parallel=tree_parallel,
+                           reuse=False)
+    o = ai_play.RandomPlayer("o")
+    game = engine([x, o])
+    game.set_state(state)
+    if workers > 1:
+        # start the workers before timing
+        x.worker_pool()
+    start = time.time()
+    for _ in range(moves):
+        x.search(game)
+    elapsed = time.time() - start
+    x.close()
+    return playouts*moves/elapsed
+
+
+@click.command()
+@click.option("--playouts", "-n", default=2000)
+@click.option("--moves", "-m", default=3)
+@click.option("--workers", "-w", "worker_counts", default="1,2,4",
+              help="Comma separated worker counts.")
+@click.option("--engine", "-e", "engine", default="bitboard",
+              type=click.Choice(["core", "bitboard"]))
+@click.option("--seed", default=0)
+def main(playouts, moves, worker_counts, engine, seed):
+    """Compare playouts per second of root and tree parallel search."""
+    random.seed(seed)
+    engine = game_factory.get_engine(engine)
+    x = ai_play.RandomPlayer("x")
+    o = ai_play.RandomPlayer("o")
+    game = engine([x, o])
+    for player in game.play():
+        if player is o:
+            break
+    game.next_player()
+    state = game.compact_state()
+    print("{:>8s} {:>14s} {:>14s}".format("workers", "root/s", "tree/s"))
+    for workers in map(int, worker_counts.split(",")):
+        rates = [search_rate(engine, playouts, workers, tree_parallel, state,
+                             moves)
+                 for tree_parallel in (False, True)]
+        print("{:8d} {:14.1f} {:14.1f}".format(workers, *rates))
+
+
+if __name__ == '__main__':
+    main()
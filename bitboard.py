@@ -0,0 +1,284 @@
+import collections
+import itertools
+import random
+
+import core
+import zobrist
+
+
+DIGITS = bytes.maketrans(bytes(range(10)), b"0123456789")
+UNDIGITS = bytes.maketrans(b"0123456789", bytes(range(10)))
+
+_neighbor_masks = {}
+
+
+def neighbor_masks(size):
+    """Bitmask of the adjacent cells for every cell of a size x size board."""
+    try:
+        return _neighbor_masks[size]
+    except KeyError:
+        pass
+    masks = [sum(1 << i for i in neighbors)
+             for neighbors in core.neighbor_table(size)]
+    _neighbor_masks[size] = masks
+    return masks
+
+
+def bits(mask):
+    """Indices of the set bits of mask, lowest first."""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+_neighbor_bits = {}
+
+
+def neighbor_bits(mask):
+    """Cached tuple of bits(mask) for masks within one neighborhood.
+
+    There are at most 256 such masks per space, so the cache stays small.
+    """
+    try:
+        return _neighbor_bits[mask]
+    except KeyError:
+        _neighbor_bits[mask] = tuple(bits(mask))
+        return _neighbor_bits[mask]
+
+
+class BitboardGame(core.Game):
+    """Game engine keeping levels and occupancy as integer bitmasks.
+
+    Cells are indexed like core.Game.board (row by row). level_masks[k] holds
+    the cells at level k (4 is a dome), occupied holds the cells with a pawn.
+    States are the same strings as core.Game.compact_state, so both engines
+    share trees and can be swapped freely.
+    """
+
+    def __init__(self, players, size=5):
+        self.size = size
+        self.cells = size**2
+        self.full = (1 << self.cells) - 1
+        self.neighbors = neighbor_masks(size)
+        self.players = list(players)
+        self.player_nums = {player: i for i, player in enumerate(self.players)}
+        self.zobrist_levels, self.zobrist_occupants = zobrist.tables(
+            size, len(self.players))
+        num_players = len(self.players)
+        self.relative = []
+        for active in range(num_players):
+            owners = bytes(range(num_players + 1))
+            digits = b"0" + bytes(48 + (owner - active) % num_players + 1
+                                  for owner in range(num_players))
+            self.relative.append(bytes.maketrans(owners, digits))
+        self.reset()
+
+    def reset(self):
+        self.levels = bytearray(self.cells)
+        self.level_masks = [self.full, 0, 0, 0, 0]
+        self.owners = bytearray(self.cells)
+        self.occupied = 0
+        self.positions = [[None]*len(player.pawns) for player in self.players]
+        self.turns = collections.deque(self.players)
+        self.history = []
+        self.hashes = [0]*len(self.players)
+        for player in self.players:
+            player.reset()
+
+    def print_state(self):
+        print("  " + "   ".join([core.xchar(i) for i in range(self.size)]), end="")
+        for cell in range(self.cells):
+            x, y = cell % self.size, cell // self.size
+            if not x:
+                print("\n{:d}|".format(y+1), end="")
+            owner = self.owners[cell]
+            player = self.players[owner - 1] if owner else ""
+            print("{:d} {:1.1s}|".format(self.levels[cell], str(player)), end="")
+        print("\n")
+
+    def compact_state(self):
+        active_num = self.player_nums[self.active_player()]
+        return self._state(self.relative[active_num])
+
+    def _state(self, relative):
+        return (self.levels.translate(DIGITS) +
+                self.owners.translate(relative)).decode()
+
+    def set_state(self, state):
+        active_player = self.active_player()
+        self.reset()
+        self.set_turn(active_player)
+        active_num = self.player_nums[active_player]
+        num_players = len(self.players)
+        self.levels = bytearray(state[:self.cells].encode().translate(UNDIGITS))
+        self.level_masks = [0]*5
+        for cell, level in enumerate(self.levels):
+            self.level_masks[level] |= 1 << cell
+        playernums = state[self.cells:]
+        for cell, playernum in enumerate(playernums):
+            if playernum != "0":
+                player_num = (active_num + int(playernum) - 1) % num_players
+                positions = self.positions[player_num]
+                self._place(player_num, positions.index(None), cell)
+        self.rehash()
+
+    def rehash(self):
+        self.hashes = [0]*len(self.players)
+        for cell, level in enumerate(self.levels):
+            self._hash_level(cell, 0, level)
+            if self.owners[cell]:
+                self._hash_pawn(self.owners[cell] - 1, cell)
+
+    def _place(self, player_num, pawn, cell):
+        self.positions[player_num][pawn] = cell
+        self.owners[cell] = player_num + 1
+        self.occupied |= 1 << cell
+
+    def _move(self, player_num, pawn, cell):
+        start = self.positions[player_num][pawn]
+        self.owners[start] = 0
+        self.occupied ^= 1 << start
+        self._place(player_num, pawn, cell)
+
+    def _build(self, cell):
+        level = self.levels[cell]
+        self.levels[cell] = level + 1
+        self.level_masks[level] ^= 1 << cell
+        self.level_masks[level + 1] |= 1 << cell
+
+    def _unbuild(self, cell):
+        level = self.levels[cell]
+        self.levels[cell] = level - 1
+        self.level_masks[level] ^= 1 << cell
+        self.level_masks[level - 1] |= 1 << cell
+
+    def _move_mask(self, cell):
+        """Cells a pawn on cell can move to."""
+        masks = self.level_masks
+        climbable = masks[0] | masks[1]
+        level = self.levels[cell]
+        if level >= 1:
+            climbable |= masks[2]
+        if level >= 2:
+            climbable |= masks[3]
+        return self.neighbors[cell] & ~self.occupied & climbable
+
+    def _build_mask(self, cell):
+        """Cells a pawn on cell can build on."""
+        return self.neighbors[cell] & ~self.occupied & ~self.level_masks[4]
+
+    def setup_check(self, player):
+        return None not in self.positions[self.player_nums[player]]
+
+    def setup_actions(self, player):
+        player_num = self.player_nums[player]
+        free = list(bits(~self.occupied & self.full))
+        return list(itertools.permutations(free, len(self.positions[player_num])))
+
+    def legal_actions(self, player):
+        player_num = self.player_nums[player]
+        levels = self.levels
+        neighbors = self.neighbors
+        actions = []
+        for pawn, start in enumerate(self.positions[player_num]):
+            start_level = levels[start]
+            # the moving pawn leaves start, a pawn never builds where it stands
+            buildable = ~(self.occupied ^ 1 << start) & ~self.level_masks[4]
+            for cell in neighbor_bits(self._move_mask(start)):
+                if levels[cell] == 3 and start_level < 3:
+                    actions.append((pawn, cell, None))
+                    continue
+                actions += [(pawn, cell, build_cell) for build_cell
+                            in neighbor_bits(neighbors[cell] & buildable)]
+        return actions
+
+    def apply_setup(self, action, player=None):
+        if not player:
+            player = self.active_player()
+        player_num = self.player_nums[player]
+        for pawn, cell in enumerate(action):
+            self._place(player_num, pawn, cell)
+            self._hash_pawn(player_num, cell)
+        self.history.append((player_num, action, None, player.winner))
+
+    def apply(self, action, player=None):
+        if not player:
+            player = self.active_player()
+        player_num = self.player_nums[player]
+        pawn, cell, build_cell = action
+        start = self.positions[player_num][pawn]
+        self.history.append((player_num, action, start, player.winner))
+        self._move(player_num, pawn, cell)
+        self._hash_pawn(player_num, start)
+        self._hash_pawn(player_num, cell)
+        if build_cell is None:
+            player.winner = True
+        else:
+            self._build(build_cell)
+            level = self.levels[build_cell]
+            self._hash_level(build_cell, level - 1, level)
+
+    def undo(self):
+        player_num, action, start, winner = self.history.pop()
+        self.players[player_num].winner = winner
+        if start is None:
+            for pawn, cell in enumerate(action):
+                self.positions[player_num][pawn] = None
+                self.owners[cell] = 0
+                self.occupied ^= 1 << cell
+                self._hash_pawn(player_num, cell)
+            return
+        pawn, cell, build_cell = action
+        if build_cell is not None:
+            self._unbuild(build_cell)
+            level = self.levels[build_cell]
+            self._hash_level(build_cell, level + 1, level)
+        self._move(player_num, pawn, start)
+        self._hash_pawn(player_num, cell)
+        self._hash_pawn(player_num, start)
+
+    def enumerate_setup_options(self, player):
+        relative = self.relative[self.player_nums[self.active_player()]]
+        options = set()
+        for action in self.setup_actions(player):
+            self.apply_setup(action, player)
+            options.add((self._state(relative), False))
+            self.undo()
+        return list(options)
+
+    def turn_options(self, player):
+        player_num = self.player_nums[player]
+        relative = self.relative[self.player_nums[self.active_player()]]
+        options = set()
+        for pawn, start in enumerate(self.positions[player_num]):
+            start_level = self.levels[start]
+            for cell in neighbor_bits(self._move_mask(start)):
+                self._move(player_num, pawn, cell)
+                if self.levels[cell] == 3 and start_level < 3:
+                    options.add((self._state(relative), True))
+                else:
+                    for build_cell in neighbor_bits(self._build_mask(cell)):
+                        self._build(build_cell)
+                        options.add((self._state(relative), False))
+                        self._unbuild(build_cell)
+                self._move(player_num, pawn, start)
+        return list(options)
+
+    def update_winner(self, player):
+        for cell in self.positions[self.player_nums[player]]:
+            if self.levels[cell] == 3:
+                player.winner = True
+
+    def random_setup(self, player):
+        free = list(bits(~self.occupied & self.full))
+        num_pawns = len(self.positions[self.player_nums[player]])
+        self.apply_setup(tuple(random.sample(free, num_pawns)), player)
+
+    def has_winning_move(self, player):
+        targets = self.level_masks[3] & ~self.occupied
+        for cell in self.positions[self.player_nums[player]]:
+            if cell is not None and self.levels[cell] == 2:
+                if self.neighbors[cell] & targets:
+                    return True
+        return False
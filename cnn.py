@@ -1,45 +1,40 @@
+import collections
 import math
+import os
+import random
+import time
 import numpy as np
 import torch
 import torch.nn.functional as F
 
-
-MODEL_PATH = "santorini.pt"
-
-
-def get_samples(tree, n=10):
-    samples = []
-    for s in tree.sample(n):
-        samples.append(s)
-    return samples
+import codec
 
 
-def convert_state(state):
-    i = int(len(state)/2)
-    levels = np.array(list(state[:i]), dtype=int) / 4
-    players = np.array(list(state[i:]), dtype=int)
-    players[players > 1] = -1
-    return levels, players
-
-
-def parse_record(record):
-    state = record["_id"]
-    target = record["wins"] / record["tries"]
-    tries = record["tries"]
-    return state, target, tries
+MODEL_PATH = "santorini.pt"
+INFERENCE_PATH = "santorini_cpu.pt"
+CHECKPOINT_PATH = "santorini.ckpt"
+CACHE_SIZE = 1 << 18
+RELOAD_SECONDS = 5  # between checks of the model file
+BATCH_SIZE = 256
+LEARNING_RATE = 1e-4
 
 
 def states_to_torch(states):
-    state_splits = [convert_state(state) for state in states]
-    x_flat = torch.as_tensor(state_splits, dtype=torch.float)
-    x_dim = int(math.sqrt(x_flat.shape[2]))
-    x = torch.reshape(x_flat, [len(states), 2, x_dim, x_dim])
-    return x
+    """(N, 2, size, size) tensor of states, or of packed keys of one format."""
+    levels, players = codec.decode_array(states)
+    n, cells = levels.shape
+    x_dim = int(math.sqrt(cells))
+    x = np.empty((n, 2, cells), dtype=np.float32)
+    x[:, 0] = levels / 4
+    x[:, 1] = np.where(players > 1, -1, players)
+    return torch.from_numpy(x.reshape(n, 2, x_dim, x_dim))
 
 
 def samples_to_torch(samples):
-    states, targets, tries = list(zip(*(parse_record(record) for record in samples)))
-    x = states_to_torch(states)
+    keys = [record["_id"] for record in samples]
+    targets = [record["wins"] / record["tries"] for record in samples]
+    tries = [record["tries"] for record in samples]
+    x = states_to_torch(keys)
     y_flat = torch.as_tensor(targets, dtype=torch.float)
     y = torch.reshape(y_flat, [len(samples), 1])
     w_flat = torch.as_tensor(tries, dtype=torch.float)
@@ -47,6 +42,57 @@ def samples_to_torch(samples):
     return x, y, w
 
 
+def reservoir_sample(items, n):
+    """n items drawn uniformly from an iterable in one pass, shuffled."""
+    sample = []
+    for i, item in enumerate(items):
+        if i < n:
+            sample.append(item)
+        else:
+            j = random.randrange(i + 1)
+            if j < n:
+                sample[j] = item
+    random.shuffle(sample)
+    return sample
+
+
+class TreeDataset(torch.utils.data.IterableDataset):
+    """(x, y, w) minibatches of n records streamed from a tree.
+
+    Records come from tree.sample when the tree has it, else from a
+    reservoir sample of tree.items(), drawn again on each iteration. Records
+    without tries are skipped. Use with a DataLoader with batch_size=None,
+    since batches are built here.
+    """
+
+    def __init__(self, tree, n, batch_size=BATCH_SIZE):
+        if tree.key_format == "zobrist":
+            raise ValueError("Zobrist keys cannot be decoded into states")
+        self.tree = tree
+        self.n = n
+        self.batch_size = batch_size
+
+    def records(self):
+        if hasattr(self.tree, "sample"):
+            return self.tree.sample(self.n)
+        records = ({"_id": state, "tries": record["tries"],
+                    "wins": record["wins"]}
+                   for state, record in self.tree.items() if record["tries"])
+        return reservoir_sample(records, self.n)
+
+    def __iter__(self):
+        batch = []
+        for record in self.records():
+            if not record["tries"]:
+                continue
+            batch.append(record)
+            if len(batch) == self.batch_size:
+                yield samples_to_torch(batch)
+                batch = []
+        if batch:
+            yield samples_to_torch(batch)
+
+
 class ValueNet(torch.nn.Module):
     def __init__(self):
         super().__init__()
@@ -62,10 +108,20 @@ class ValueNet(torch.nn.Module):
         return x
 
 
-def train_epoch(model, x, y, w, learning_rate=1e-4):
+def make_optimizer(model, learning_rate=LEARNING_RATE):
+    return torch.optim.Adam(model.parameters(), lr=learning_rate)
+
+
+def train_epoch(model, x, y, w, learning_rate=LEARNING_RATE, optimizer=None):
+    if optimizer is None:
+        optimizer = make_optimizer(model, learning_rate)
+    return train_batch(model, optimizer, x, y, w)
+
+
+def train_batch(model, optimizer, x, y, w):
+    """One optimizer step on a minibatch, return predictions and loss."""
     model.train()
     criterion = torch.nn.BCEWithLogitsLoss(weight=w)
-    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
     y_pred = model(x)
     loss = criterion(y_pred, y)
     optimizer.zero_grad()
@@ -85,10 +141,139 @@ def to_numpy(t):
     return t.squeeze().detach().numpy()
 
 
-def max_state(states, model):
+class EvalQueue(object):
+    """Win probabilities of states from many callers in batched passes.
+
+    Callers put lists of states and get a ticket. The first result asked
+    for scores all pending states with one forward pass per max_batch
+    states.
+    """
+
+    def __init__(self, model, max_batch=4096):
+        self.model = model
+        self.max_batch = max_batch
+        self.pending = []
+        self.results = {}
+        self.tickets = 0
+
+    def put(self, states):
+        ticket = self.tickets
+        self.tickets += 1
+        self.pending.append((ticket, states))
+        return ticket
+
+    def flush(self):
+        states = [state for _, group in self.pending for state in group]
+        probs = np.empty(len(states))
+        for start in range(0, len(states), self.max_batch):
+            batch = states[start:start + self.max_batch]
+            probs[start:start + len(batch)] = state_values(batch, self.model)
+        start = 0
+        for ticket, group in self.pending:
+            self.results[ticket] = probs[start:start + len(group)]
+            start += len(group)
+        self.pending = []
+
+    def result(self, ticket):
+        """Probabilities of the states put with ticket."""
+        if ticket not in self.results:
+            self.flush()
+        return self.results.pop(ticket)
+
+    def __call__(self, states):
+        return self.result(self.put(states))
+
+
+class ValueCache(object):
+    """Value network with an LRU cache of the win probabilities of states.
+
+    The network is loaded from model_path with loader, unless a model is
+    given, and reloaded with an empty cache when the file changes, e.g. when
+    cnn_train.py saves a new model. The file is checked at most every
+    RELOAD_SECONDS. A given model is kept, it has no file to follow.
+    """
+
+    def __init__(self, model_path=MODEL_PATH, maxsize=CACHE_SIZE, model=None,
+                 loader=None):
+        self.model_path = None if model is not None else model_path
+        self.maxsize = maxsize
+        self.loader = loader or load_model
+        self.values = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.model = model
+        self.version = self.model_version()
+        self.checked = time.monotonic()
+        if model is None:
+            self.reload()
+
+    def model_version(self):
+        if not self.model_path:
+            return None
+        try:
+            return os.stat(self.model_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def reload(self):
+        self.version = self.model_version()
+        self.model = self.loader(self.model_path)
+        self.values.clear()
+
+    def check_reload(self):
+        """Reload the model if its file was replaced since the last check."""
+        if not self.model_path:
+            return
+        now = time.monotonic()
+        if now - self.checked < RELOAD_SECONDS:
+            return
+        self.checked = now
+        version = self.model_version()
+        # a missing file is being replaced, keep the loaded model
+        if version is not None and version != self.version:
+            self.reload()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits/lookups if lookups else 0
+
+    def __call__(self, states):
+        """Win probabilities of states, evaluating only uncached states."""
+        self.check_reload()
+        probs = np.empty(len(states))
+        missing = []
+        for i, state in enumerate(states):
+            try:
+                probs[i] = self.values[state]
+            except KeyError:
+                missing.append(i)
+                continue
+            self.values.move_to_end(state)
+        self.hits += len(states) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            new_probs = state_values([states[i] for i in missing], self.model)
+            for i, prob in zip(missing, new_probs):
+                probs[i] = prob
+                self.values[states[i]] = prob
+            while len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+        return probs
+
+
+def state_values(states, model):
+    """Win probabilities of states as a NumPy array.
+
+    model is a ValueNet or a ValueCache.
+    """
+    if isinstance(model, ValueCache):
+        return model(states)
     x = states_to_torch(states)
-    probs = predict_proba(model, x)
-    idxmax = to_numpy(probs).argmax()
+    return to_numpy(predict_proba(model, x)).reshape(-1)
+
+
+def max_state(states, model):
+    idxmax = state_values(states, model).argmax()
     return states[idxmax]
 
 
@@ -96,3 +281,58 @@ def load_model(model_path=MODEL_PATH):
     model = ValueNet()
     model.load_state_dict(torch.load(model_path))
     return model
+
+
+def save_model(model, model_path=MODEL_PATH):
+    """Save the model weights, replacing model_path in one step."""
+    tmp_path = model_path + ".tmp"
+    torch.save(model.state_dict(), tmp_path)
+    os.replace(tmp_path, model_path)
+
+
+def export_inference_model(model, path=INFERENCE_PATH, quantize=True,
+                           size=5):
+    """Save model as a frozen TorchScript module for CPU inference.
+
+    The model is put in eval mode, so dropout is off, and with quantize its
+    linear layer runs on int8 weights. The convolution stays float, since
+    dynamic quantization only covers linear layers.
+    """
+    model.eval()
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, torch.zeros(1, 2, size, size))
+    torch.jit.save(torch.jit.freeze(traced), path)
+
+
+def load_inference_model(path=INFERENCE_PATH, threads=None):
+    """Load a model saved by export_inference_model.
+
+    threads sets the number of intra-op threads of torch in this process.
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    return torch.jit.load(path)
+
+
+def save_checkpoint(model, optimizer, samples,
+                    checkpoint_path=CHECKPOINT_PATH):
+    """Save model, optimizer state and the number of samples trained on."""
+    tmp_path = checkpoint_path + ".tmp"
+    torch.save({"model": model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "samples": samples}, tmp_path)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def load_checkpoint(checkpoint_path=CHECKPOINT_PATH,
+                    learning_rate=LEARNING_RATE):
+    """Model, optimizer and number of samples trained on from a checkpoint."""
+    checkpoint = torch.load(checkpoint_path)
+    model = ValueNet()
+    model.load_state_dict(checkpoint["model"])
+    optimizer = make_optimizer(model, learning_rate)
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    return model, optimizer, checkpoint["samples"]
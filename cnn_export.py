@@ -0,0 +1,84 @@
+import os
+import random
+import tempfile
+import time
+
+import click
+import torch
+
+import ai_play
+import bitboard
+import cnn
+
+
+def random_states(n):
+    """States of n random self-play turns."""
+    states = []
+    while len(states) < n:
+        x = ai_play.RandomPlayer("x")
+        o = ai_play.RandomPlayer("o")
+        game = bitboard.BitboardGame([x, o])
+        for player in game.play():
+            states.append(game.compact_state())
+    return states[:n]
+
+
+def latency(model, x, repeats):
+    """Mean seconds per forward pass of x."""
+    cnn.predict_proba(model, x)
+    start = time.time()
+    for _ in range(repeats):
+        cnn.predict_proba(model, x)
+    return (time.time() - start)/repeats
+
+
+def compare(model, inference_models, n, batch_size, repeats):
+    """Print error and latency of inference models against model."""
+    x = cnn.states_to_torch(random_states(n))
+    y = cnn.to_numpy(cnn.predict_proba(model, x))
+    batch = x[:batch_size]
+    print("{:>10s} {:>10s} {:>10s} {:>12s} {:>12s}".format(
+        "model", "max error", "argmax", "1 state ms",
+        "{:d} states ms".format(len(batch))))
+    models = [("float", model)] + inference_models
+    for name, m in models:
+        y_m = cnn.to_numpy(cnn.predict_proba(m, x))
+        # agreement of the best state among groups of batch_size states
+        groups = len(y) // batch_size * batch_size
+        agree = (y[:groups].reshape(-1, batch_size).argmax(axis=1)
+                 == y_m[:groups].reshape(-1, batch_size).argmax(axis=1))
+        print("{:>10s} {:10.4f} {:10.1%} {:12.3f} {:12.3f}".format(
+            name, abs(y - y_m).max(), agree.mean(),
+            1000*latency(m, x[:1], repeats), 1000*latency(m, batch, repeats)))
+
+
+@click.command()
+@click.option("--model_path", "-p", "model_path", default=cnn.MODEL_PATH)
+@click.option("--output", "-o", "output", default=cnn.INFERENCE_PATH)
+@click.option("--no-quantize", "quantize", is_flag=True, default=True,
+              flag_value=False, help="Keep float weights.")
+@click.option("--threads", "-t", type=int, default=None,
+              help="Intra-op threads of torch.")
+@click.option("--compare", "-c", "n", type=int, default=0,
+              help="Compare with the float model on n random states.")
+@click.option("--batch-size", "-b", "batch_size", type=int, default=32)
+@click.option("--repeats", "-r", type=int, default=100)
+def main(model_path, output, quantize, threads, n, batch_size, repeats):
+    """Export a model for CPU inference by CNN players."""
+    model = cnn.load_model(model_path)
+    cnn.export_inference_model(model, output, quantize=quantize)
+    print(f"Saved {output}.")
+    if n:
+        random.seed(0)
+        inference_model = cnn.load_inference_model(output, threads=threads)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            scripted = os.path.join(tmp_dir, "script.pt")
+            cnn.export_inference_model(model, scripted, quantize=False)
+            inference_models = [("script", torch.jit.load(scripted))]
+        if quantize:
+            inference_models.append(("quantized", inference_model))
+        compare(model, inference_models, n, batch_size, repeats)
+
+
+if __name__ == '__main__':
+    main()
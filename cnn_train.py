@@ -1,3 +1,6 @@
+import os
+import time
+
 import click
 import torch
 
@@ -5,31 +8,60 @@ import cnn
 import factory
 
 
+def load(model_path, checkpoint_path, learning_rate):
+    """Model, optimizer and samples trained on, from the last checkpoint."""
+    try:
+        return cnn.load_checkpoint(checkpoint_path, learning_rate)
+    except FileNotFoundError:
+        print(f"No checkpoint found at {checkpoint_path}.")
+    if os.path.exists(model_path):
+        model = cnn.load_model(model_path)
+    else:
+        print(f"No file found at {model_path}.")
+        model = cnn.ValueNet()
+    return model, cnn.make_optimizer(model, learning_rate), 0
+
+
 @click.command()
 @click.option("--iters", "-i", type=int, default=1000)
-@click.option("--n", "-n", type=int, default=50000)
-@click.option("--epochs", "-e", "epochs", type=int, default=100)
+@click.option("--n", "-n", type=int, default=50000,
+              help="Samples streamed from the tree per epoch.")
+@click.option("--epochs", "-e", "epochs", type=int, default=1,
+              help="Samples of n records trained on per iteration, each "
+                   "drawn anew.")
+@click.option("--batch-size", "-b", "batch_size", type=int,
+              default=cnn.BATCH_SIZE)
+@click.option("--learning-rate", "learning_rate", type=float,
+              default=cnn.LEARNING_RATE)
+@click.option("--format", "-f", "format", default="mongo_bulk")
 @click.option("--db", "db", default="cnn")
 @click.option("--model_path", "-p", "model_path", default=cnn.MODEL_PATH)
-@click.option("--printn", "printn", type=int, default=10)
-def main(iters, n, epochs, db, model_path, printn=100):
-    for i in range(iters):
-        try:
-            model = cnn.load_model(model_path)
-        except FileNotFoundError:
-            print(f"No file found at {model_path}.")
-            model = cnn.ValueNet()
-        print("Get samples")
-        with factory.serializer_factory.get_serializer("mongo_bulk", db=db) as tree:
-            samples = cnn.get_samples(tree, n=n)
-        print("Convert to torch")
-        x, y, w = cnn.samples_to_torch(samples)
-        print("Train model")
-        for epoch in range(epochs):
-            y_pred, loss = cnn.train_epoch(model, x, y, w)
-            if not epoch % printn:
-                print(epoch, loss.item())
-        torch.save(model.state_dict(), model_path)
+@click.option("--checkpoint", "-c", "checkpoint_path",
+              default=cnn.CHECKPOINT_PATH)
+@click.option("--printn", "printn", type=int, default=10,
+              help="Print the loss every printn minibatches.")
+def main(iters, n, epochs, batch_size, learning_rate, format, db, model_path,
+         checkpoint_path, printn):
+    model, optimizer, trained = load(model_path, checkpoint_path,
+                                     learning_rate)
+    with factory.serializer_factory.get_serializer(format, db=db) as tree:
+        for i in range(iters):
+            dataset = cnn.TreeDataset(tree, n, batch_size=batch_size)
+            loader = torch.utils.data.DataLoader(dataset, batch_size=None)
+            samples = 0
+            start = time.time()
+            for epoch in range(epochs):
+                for batch, (x, y, w) in enumerate(loader):
+                    y_pred, loss = cnn.train_batch(model, optimizer, x, y, w)
+                    samples += len(x)
+                    if not batch % printn:
+                        print(i, epoch, batch, loss.item())
+            elapsed = max(time.time() - start, 1e-9)
+            trained += samples
+            print(f"Iteration {i}: {samples} samples in {elapsed:.1f}s, "
+                  f"{samples/elapsed:.0f} samples/s, {trained} in total")
+            cnn.save_model(model, model_path)
+            cnn.save_checkpoint(model, optimizer, trained, checkpoint_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,120 @@
+"""Packed keys for compact game states.
+
+A compact state is a string of one level digit per space followed by one
+occupant digit per space. A packed key stores each space in 5 bits, 3 bits of
+level and 2 bits of occupant, with the first space in the highest bits. The
+5x5 board packs into a 125 bit int, or 16 bytes.
+"""
+import math
+
+import numpy as np
+
+import zobrist
+
+
+LEVEL_BITS = 3
+OCCUPANT_BITS = 2
+CELL_BITS = LEVEL_BITS + OCCUPANT_BITS
+SIZE = 5
+
+BASE32 = "0123456789abcdefghijklmnopqrstuv"
+PAIRS = {str(level) + str(occupant): BASE32[(level << OCCUPANT_BITS) | occupant]
+         for level in range(1 << LEVEL_BITS)
+         for occupant in range(1 << OCCUPANT_BITS)}
+CELLS = [(str(value >> OCCUPANT_BITS), str(value & 3)) for value in range(32)]
+
+
+def identity(state):
+    return state
+
+
+def pack(state):
+    """Pack a compact state string into an int."""
+    i = len(state) // 2
+    return int("".join(map(PAIRS.__getitem__,
+                           map(str.__add__, state[:i], state[i:]))), 32)
+
+
+def unpack(key, size=SIZE):
+    """Unpack an int key into a compact state string."""
+    cells = size**2
+    levels = [None]*cells
+    occupants = [None]*cells
+    for i in range(cells - 1, -1, -1):
+        levels[i], occupants[i] = CELLS[key & 31]
+        key >>= CELL_BITS
+    return "".join(levels) + "".join(occupants)
+
+
+def key_bytes(size=SIZE):
+    """Number of bytes of a packed key for a size x size board."""
+    return math.ceil(size**2 * CELL_BITS / 8)
+
+
+def pack_bytes(state):
+    """Pack a compact state string into bytes."""
+    size = math.isqrt(len(state) // 2)
+    return pack(state).to_bytes(key_bytes(size), "big")
+
+
+def unpack_bytes(key, size=SIZE):
+    """Unpack a bytes key into a compact state string."""
+    return unpack(int.from_bytes(key, "big"), size)
+
+
+def decode(key, size=SIZE):
+    """Compact state string of a key in any format."""
+    if isinstance(key, str):
+        return key
+    if isinstance(key, int):
+        return unpack(key, size)
+    return unpack_bytes(bytes(key), size)
+
+
+def decode_array(keys, size=SIZE):
+    """Levels and occupants, as (N, cells) int8 arrays, of N keys of one format.
+
+    States are read with np.frombuffer over their joined characters and
+    packed keys over their joined bytes, without work per key beyond
+    joining them.
+    """
+    n = len(keys)
+    cells = size**2
+    if isinstance(keys[0], str):
+        digits = np.frombuffer("".join(keys).encode(), dtype=np.int8)
+        digits = digits.reshape(n, 2*cells) - ord("0")
+        return digits[:, :cells], digits[:, cells:]
+    nbytes = key_bytes(size)
+    if isinstance(keys[0], int):
+        data = b"".join(key.to_bytes(nbytes, "big") for key in keys)
+    else:
+        data = b"".join(map(bytes, keys))
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8).reshape(n, nbytes),
+                         axis=1)
+    bits = bits[:, -cells*CELL_BITS:].reshape(n, cells, CELL_BITS)
+    levels = bits[:, :, :LEVEL_BITS] @ (1 << np.arange(LEVEL_BITS - 1, -1, -1))
+    occupants = (bits[:, :, LEVEL_BITS:]
+                 @ (1 << np.arange(OCCUPANT_BITS - 1, -1, -1)))
+    return levels.astype(np.int8), occupants.astype(np.int8)
+
+
+def undecodable(key):
+    raise ValueError("Key {!r} cannot be decoded".format(key))
+
+
+KEY_FORMATS = {
+    "string": (identity, identity),
+    "int": (pack, unpack),
+    "bytes": (pack_bytes, unpack_bytes),
+    "zobrist": (zobrist.hash_state, undecodable),
+}
+
+
+def get_codec(key_format=None):
+    """(encode, decode) functions between state strings and tree keys."""
+    if not key_format:
+        key_format = "string"
+    try:
+        return KEY_FORMATS[key_format]
+    except KeyError:
+        raise ValueError(key_format)
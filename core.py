@@ -1,5 +1,9 @@
 import collections
 import itertools
+import random
+
+import symmetry
+import zobrist
 
 
 def xchar(x):
@@ -7,12 +11,37 @@ def xchar(x):
     return chr(x+65)
 
 
+_neighbor_tables = {}
+_setup_options = {}
+
+
+def neighbor_table(size):
+    """Indices of the adjacent spaces for every space of a size x size board."""
+    try:
+        return _neighbor_tables[size]
+    except KeyError:
+        pass
+    table = []
+    for y in range(size):
+        for x in range(size):
+            neighbors = []
+            for ny in range(max(y-1, 0), min(y+2, size)):
+                for nx in range(max(x-1, 0), min(x+2, size)):
+                    if (nx, ny) != (x, y):
+                        neighbors.append(ny*size + nx)
+            table.append(tuple(neighbors))
+    _neighbor_tables[size] = table
+    return table
+
+
 class Space(object):
     """Board space."""
+    __slots__ = ("x", "y", "index", "level", "player")
 
-    def __init__(self, x, y):
+    def __init__(self, x, y, index=None):
         self.x = x
         self.y = y
+        self.index = index
         self.level = 0
         self.player = None
 
@@ -33,8 +62,14 @@ class Game(object):
 
     def __init__(self, players, size=5):
         self.size = size
-        self.board = [Space(x, y) for y in range(self.size) for x in range(self.size)]
+        self.board = [Space(x, y, y*self.size + x)
+                      for y in range(self.size) for x in range(self.size)]
+        self.neighbors = [[self.board[i] for i in neighbors]
+                          for neighbors in neighbor_table(self.size)]
         self.players = list(players)
+        self.player_nums = {player: i for i, player in enumerate(self.players)}
+        self.zobrist_levels, self.zobrist_occupants = zobrist.tables(
+            self.size, len(self.players))
         self.reset()
 
     def reset(self):
@@ -42,12 +77,14 @@ class Game(object):
             space.level = 0
             space.player = None
         self.turns = collections.deque(self.players)
+        self.history = []
+        self.hashes = [0]*len(self.players)
         for player in self.players:
             player.reset()
 
     def play(self):
         for player in self.players:
-            if not player.setup_check():
+            if not self.setup_check(player):
                 player.setup(self)
                 yield self.active_player()
                 self.next_player()
@@ -99,26 +136,200 @@ class Game(object):
                 board_state[p_i] = "0"
         return "".join(board_state)
 
+    def state_hash(self):
+        """Zobrist hash of compact_state, kept up to date by apply and undo."""
+        return self.hashes[self.player_nums[self.active_player()]]
+
+    def rehash(self):
+        """Recompute the hashes after changing the board by other means."""
+        self.hashes = [0]*len(self.players)
+        for space in self.board:
+            self._hash_level(space.index, 0, space.level)
+            if space.player:
+                self._hash_pawn(self.player_nums[space.player], space.index)
+
+    def _hash_pawn(self, player_num, index):
+        """Toggle a pawn of player_num on space index in the hashes."""
+        occupants = self.zobrist_occupants[index]
+        hashes = self.hashes
+        num_players = len(hashes)
+        for active_num in range(num_players):
+            hashes[active_num] ^= occupants[(player_num - active_num)
+                                            % num_players + 1]
+
+    def _hash_level(self, index, old_level, new_level):
+        levels = self.zobrist_levels[index]
+        delta = levels[old_level] ^ levels[new_level]
+        if delta:
+            hashes = self.hashes
+            for active_num in range(len(hashes)):
+                hashes[active_num] ^= delta
+
+    def restart(self, state, player=None):
+        """Reuse the game from state with player, or the first player, to move."""
+        self.turns = collections.deque(self.players)
+        self.set_turn(player or self.players[0])
+        self.set_state(state)
+
     def set_state(self, state):
         active_player = self.active_player()
         self.reset()
         self.set_turn(active_player)
         levels = state[:self.size**2]
         playernums = state[self.size**2:]
+        unplaced = {player: iter(player.pawns) for player in self.players}
         for space, level, playernum in zip(self.board, levels, playernums):
             space.level = int(level)
-            playernum = int(playernum)
-            if playernum:
-                space.player = self.turns[playernum - 1]
-                for pawn in space.player.pawns:
-                    if not pawn.space:
-                        pawn.space = space
-                        break
-            else:
-                space.player = None
+            if playernum != "0":
+                space.player = self.turns[int(playernum) - 1]
+                next(unplaced[space.player]).space = space
+        self.rehash()
+
+    def setup_check(self, player):
+        return player.setup_check()
+
+    def setup_actions(self, player):
+        """Distinct placements of the player's pawns as tuples of space indices."""
+        free = [space.index for space in self.board if not space.player]
+        return list(itertools.permutations(free, len(player.pawns)))
+
+    def legal_actions(self, player):
+        """Legal turns as (pawn, move index, build index) tuples.
+
+        The build index is None for moves that win the game.
+        """
+        actions = []
+        for pawn_num, pawn in enumerate(player.pawns):
+            start = pawn.space
+            start.player = None
+            for move_space in pawn.move_options(self):
+                if move_space.level == 3 and start.level < 3:
+                    actions.append((pawn_num, move_space.index, None))
+                    continue
+                for build_space in self.neighbors[move_space.index]:
+                    if build_space.level <= 3 and not build_space.player:
+                        actions.append((pawn_num, move_space.index,
+                                        build_space.index))
+            start.player = player
+        return actions
+
+    def apply_setup(self, action, player=None):
+        """Place the player's pawns, undone by undo."""
+        if not player:
+            player = self.active_player()
+        player_num = self.player_nums[player]
+        for pawn, index in zip(player.pawns, action):
+            space = self.board[index]
+            space.player = player
+            pawn.space = space
+            self._hash_pawn(player_num, index)
+        self.history.append((player, action, None, player.winner))
+
+    def apply(self, action, player=None):
+        """Play a (pawn, move index, build index) action, undone by undo."""
+        if not player:
+            player = self.active_player()
+        pawn_num, move, build = action
+        pawn = player.pawns[pawn_num]
+        start = pawn.space
+        self.history.append((player, action, start, player.winner))
+        space = self.board[move]
+        start.player = None
+        space.player = player
+        pawn.space = space
+        player_num = self.player_nums[player]
+        self._hash_pawn(player_num, start.index)
+        self._hash_pawn(player_num, move)
+        if build is None:
+            player.winner = True
+        else:
+            build_space = self.board[build]
+            build_space.level += 1
+            self._hash_level(build, build_space.level - 1, build_space.level)
+
+    def undo(self):
+        """Revert the last apply or apply_setup."""
+        player, action, start, winner = self.history.pop()
+        player.winner = winner
+        player_num = self.player_nums[player]
+        if start is None:
+            for pawn, index in zip(player.pawns, action):
+                pawn.space.player = None
+                pawn.space = None
+                self._hash_pawn(player_num, index)
+            return
+        pawn_num, move, build = action
+        pawn = player.pawns[pawn_num]
+        if build is not None:
+            build_space = self.board[build]
+            build_space.level -= 1
+            self._hash_level(build, build_space.level + 1, build_space.level)
+        self._hash_pawn(player_num, move)
+        self._hash_pawn(player_num, start.index)
+        pawn.space.player = None
+        pawn.space = start
+        start.player = player
+
+    def setup_options(self, player):
+        """Setup options, one per class of symmetric placements.
+
+        Options only depend on the position and on who places, so they are
+        enumerated once per position and shared by all games.
+        """
+        num_players = len(self.players)
+        placing = (self.player_nums[player]
+                   - self.player_nums[self.active_player()]) % num_players
+        key = (self.compact_state(), placing, num_players)
+        try:
+            return list(_setup_options[key])
+        except KeyError:
+            pass
+        classes = {}
+        for option in self.enumerate_setup_options(player):
+            canonical_state = symmetry.canonical(option[0])[0]
+            if canonical_state not in classes or option < classes[canonical_state]:
+                classes[canonical_state] = option
+        options = sorted(classes.values())
+        _setup_options[key] = options
+        return list(options)
+
+    def enumerate_setup_options(self, player):
+        options = set()
+        for action in self.setup_actions(player):
+            self.apply_setup(action, player)
+            options.add((self.compact_state(), False))
+            self.undo()
+        return list(options)
+
+    def turn_options(self, player):
+        options = set()
+        for action in self.legal_actions(player):
+            self.apply(action, player)
+            options.add((self.compact_state(), action[2] is None))
+            self.undo()
+        return list(options)
+
+    def update_winner(self, player):
+        for pawn in player.pawns:
+            if pawn.space.level == 3:
+                player.winner = True
+
+    def random_setup(self, player):
+        free = [space.index for space in self.board if not space.player]
+        self.apply_setup(tuple(random.sample(free, len(player.pawns))), player)
+
+    def has_winning_move(self, player):
+        """Whether player could move up to level 3 on their turn."""
+        for pawn in player.pawns:
+            if pawn.space and pawn.space.level == 2:
+                for space in self.neighbors[pawn.space.index]:
+                    if space.level == 3 and not space.player:
+                        return True
+        return False
 
 
 class Pawn(object):
+    __slots__ = ("space",)
 
     def __init__(self):
         self.reset()
@@ -157,13 +368,17 @@ class Pawn(object):
         return [space for space in game.board if self.valid_placement(space)]
 
     def move_options(self, game):
-        return [space for space in game.board if self.valid_move(space)]
+        max_level = min(self.space.level + 1, 3)
+        return [space for space in game.neighbors[self.space.index]
+                if space.level <= max_level and not space.player]
 
     def build_options(self, game):
-        return [space for space in game.board if self.valid_build(space)]
+        return [space for space in game.neighbors[self.space.index]
+                if space.level <= 3 and not space.player]
 
 
 class Player(object):
+    __slots__ = ("name", "pawns", "active_pawn", "winner")
 
     def __init__(self, name, pawns=None):
         self.name = name
@@ -202,16 +417,7 @@ class Player(object):
         space.level += 1
 
     def setup_options(self, game):
-        pawn_options = [p.placement_options(game) for p in self.pawns]
-        setup_options = []
-        orig_state = game.compact_state()
-        for setup_option in itertools.product(*pawn_options):
-            if len(setup_option) == len(set(setup_option)):
-                self.place_pawns(setup_option)
-                state = game.compact_state()
-                setup_options.append((state, False))
-                game.set_state(orig_state)
-        return list(set(setup_options))
+        return game.setup_options(self)
 
     def place_pawns(self, spaces):
         for pawn, space in zip(self.pawns, spaces):
@@ -219,28 +425,7 @@ class Player(object):
             self.place(space)
 
     def turn_options(self, game):
-        options = []
-        orig_pawn = self.active_pawn
-        for pawn in self.pawns:
-            self.active_pawn = pawn
-            orig_space = pawn.space
-            for move_space in pawn.move_options(game):
-                self.move(move_space)
-                if self.winner:
-                    state = game.compact_state()
-                    options.append((state, True))
-                    self.winner = False
-                else:
-                    for build_space in pawn.build_options(game):
-                        self.build(build_space)
-                        state = game.compact_state()
-                        options.append((state, False))
-                        build_space.level -= 1
-                move_space.player = None
-                pawn.space = orig_space
-                orig_space.player = self
-        self.active_pawn = orig_pawn
-        return list(set(options))
+        return game.turn_options(self)
 
     def setup(self, game):
         options = self.setup_options(game)
@@ -258,9 +443,7 @@ class Player(object):
         if options:
             selection = self.select_func(options)
             game.set_state(selection)
-            for pawn in self.pawns:
-                if pawn.space.level == 3:
-                    self.winner = True
+            game.update_winner(self)
         else:
             game.turns.remove(self)
 
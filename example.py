@@ -1,30 +1,75 @@
+import functools
 import random
 
 import click
 
+import cnn
 import core
 from factory import player_factory, serializer_factory
 
 
+MCTS_AIS = ("mcts", "mcts_cnn")
+CNN_AIS = ("cnn", "uct_cnn", "mcts_cnn")
+
+
 @click.command()
 @click.option("-f", "format", default="mongo_bulk")
 @click.option("--ai", default="mcts")
 @click.option("--db", default="mcts")
 @click.option("--debug", is_flag=True)
-def play(format, ai, db, debug):
-    with serializer_factory.get_serializer(format, db=db) as tree:
+@click.option("--workers", "-w", default=1,
+              help="Processes searching each move of mcts players.")
+@click.option("--time-limit", "-t", "time_limit", default=None, type=float,
+              help="Seconds per move of mcts players, instead of playouts.")
+@click.option("--inference-model", "inference_path", default=None,
+              help="Model exported by cnn_export.py for cnn players.")
+@click.option("--threads", type=int, default=None,
+              help="Intra-op threads of the inference model.")
+@click.option("--max-states", "max_states", type=int, default=None,
+              help="States held in memory by the tree (not mongo or json).")
+@click.option("--eviction", default="lru", type=click.Choice(["lru", "visits"]),
+              help="States evicted first beyond --max-states.")
+def play(format, ai, db, debug, workers, time_limit, inference_path,
+         threads, max_states, eviction):
+    if workers > 1 and ai not in MCTS_AIS:
+        raise click.UsageError("--workers needs an mcts --ai")
+    if time_limit and ai not in MCTS_AIS:
+        raise click.UsageError("--time-limit needs an mcts --ai")
+    if inference_path and ai not in CNN_AIS:
+        raise click.UsageError("--inference-model needs a cnn --ai")
+    tree_kwargs = {"db": db}
+    if max_states:
+        tree_kwargs.update(max_states=max_states, eviction=eviction)
+    with serializer_factory.get_serializer(format, **tree_kwargs) as tree:
         x = player_factory.get_player("human", "x")
-        o = player_factory.get_player(ai, "o", tree=tree, debug=debug)
-        print("You are player x.")
-        players = [x, o]
-        random.shuffle(players)
-        game = core.Game(players)
-        print("Wait for data to load.")
-        print("Player {:s} starts".format(str(players[0])))
-        game.print_state()
-        for player in game.play():
+        ai_kwargs = {"tree": tree, "debug": debug}
+        if workers > 1:
+            ai_kwargs["workers"] = workers
+        if time_limit:
+            ai_kwargs.update(playouts=None, time_limit=time_limit,
+                             early_stop=True)
+        if inference_path:
+            ai_kwargs["model"] = cnn.ValueCache(
+                inference_path, loader=functools.partial(
+                    cnn.load_inference_model, threads=threads))
+        o = player_factory.get_player(ai, "o", **ai_kwargs)
+        try:
+            print("You are player x.")
+            players = [x, o]
+            random.shuffle(players)
+            game = core.Game(players)
+            print("Wait for data to load.")
+            print("Player {:s} starts".format(str(players[0])))
             game.print_state()
-        print("Player {:s} has won!".format(str(game.winner())))
+            for player in game.play():
+                game.print_state()
+            print("Player {:s} has won!".format(str(game.winner())))
+            if max_states:
+                print("{:d} states in memory, {:d} evicted".format(
+                    tree.resident_states, tree.evictions))
+        finally:
+            if workers > 1:
+                o.close()
 
 
 if __name__ == '__main__':
@@ -1,7 +1,9 @@
+import bitboard
 import core
 import human_play
 import ai_play
 import serialize
+import array_tree
 import json_serialize
 import mongo_serialize
 import sql_serialize
@@ -21,6 +23,8 @@ class PlayerFactory:
             return ai_play.MCTSPlayer(name, **kwargs)
         if player_type == "cnn":
             return ai_play.CNNPlayer(name, **kwargs)
+        if player_type == "uct_cnn":
+            return ai_play.UctCnnPlayer(name, **kwargs)
         if player_type == "mcts_cnn":
             return ai_play.MctsCnnPlayer(name, **kwargs)
         else:
@@ -30,7 +34,19 @@ class PlayerFactory:
 class SerializerFactory:
     def get_serializer(self, format, **kwargs):
         if not format:
-            return serialize.Tree()
+            return serialize.Tree(key_format=kwargs.get("key_format"),
+                                  canonical=kwargs.get("canonical", False),
+                                  verify=kwargs.get("verify", False),
+                                  max_states=kwargs.get("max_states"),
+                                  eviction=kwargs.get("eviction", "lru"))
+        if format == "array":
+            return array_tree.ArrayTree(key_format=kwargs.get("key_format"),
+                                        canonical=kwargs.get("canonical",
+                                                             False),
+                                        verify=kwargs.get("verify", False),
+                                        max_states=kwargs.get("max_states"),
+                                        eviction=kwargs.get("eviction",
+                                                            "lru"))
         if format == "json":
             return json_serialize.JsonTree(**kwargs)
         if format == "sql":
@@ -43,5 +59,16 @@ class SerializerFactory:
             return ValueError(format)
 
 
+class GameFactory:
+    def get_engine(self, engine):
+        if not engine or engine == "core":
+            return core.Game
+        if engine == "bitboard":
+            return bitboard.BitboardGame
+        else:
+            raise ValueError(engine)
+
+
 player_factory = PlayerFactory()
 serializer_factory = SerializerFactory()
+game_factory = GameFactory()
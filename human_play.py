@@ -20,6 +20,7 @@ class HumanPlayer(Player):
                     placed = True
                 except Exception as e:
                     print(str(e))
+        game.rehash()
 
     def turn(self, game):
         pawn_selected = False
@@ -62,3 +63,11 @@ class HumanPlayer(Player):
                     built = True
                 except Exception as e:
                     print(str(e))
+        game.rehash()
+
+
+if __name__ == '__main__':
+    # a session against an ai player, with the options of example.py such as
+    # --max-states and --eviction
+    import example
+    example.play()
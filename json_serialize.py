@@ -4,10 +4,12 @@ import serialize
 
 
 class JsonTree(serialize.Tree):
+    key_formats = ("string",)
 
-    def __init__(self, filepath="santorini.json"):
+    def __init__(self, filepath="santorini.json", key_format=None,
+                 canonical=False):
+        super().__init__(key_format=key_format, canonical=canonical)
         self.filepath = filepath
-        self.tree = {}
 
     def __enter__(self):
         with open(self.filepath) as jsonin:
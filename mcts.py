@@ -0,0 +1,136 @@
+"""In-memory search tree for Monte Carlo Tree Search.
+
+A node is a position and its expanded options. The states, winner flags,
+tries and wins of the options are kept in parallel lists, so selection is a
+loop over lists instead of tree lookups by state. Child nodes are created
+when a search first descends into an option. A serialize.Tree is only read
+to seed the statistics of new options and written by export.
+"""
+import math
+
+
+def renumber(state, player_names, new_names):
+    """State numbered relative to player_names renumbered for new_names."""
+    cells = len(state) // 2
+    table = str.maketrans({str(i + 1): str(new_names.index(name) + 1)
+                           for i, name in enumerate(player_names)})
+    return state[:cells] + state[cells:].translate(table)
+
+
+class Node(object):
+    __slots__ = ("state", "player_names", "moved", "visits", "child_names",
+                 "states", "winners", "win", "tries", "wins", "saved_tries",
+                 "saved_wins", "children", "priors")
+
+    def __init__(self, state, player_names, moved=False):
+        """Position of state, numbered relative to player_names[0].
+
+        The player after player_names[0] is to move if moved, else
+        player_names[0] itself.
+        """
+        self.state = state
+        self.player_names = tuple(player_names)
+        self.moved = moved
+        self.visits = 0
+        self.states = None
+        self.priors = None
+
+    def expanded(self):
+        return self.states is not None
+
+    def expand(self, options, child_names, tree=None):
+        """Set the (state, winner) options of the player first in child_names.
+
+        Tries and wins of options already in tree are carried over.
+        """
+        self.child_names = tuple(child_names)
+        self.states = [state for state, _ in options]
+        self.winners = [winner for _, winner in options]
+        self.win = self.winners.index(True) if any(self.winners) else None
+        self.tries = [0]*len(options)
+        self.wins = [0]*len(options)
+        if tree is not None:
+            for i, record in enumerate(tree.get_many(self.states)):
+                if record is not None:
+                    self.tries[i] = record["tries"]
+                    self.wins[i] = record["wins"]
+        self.saved_tries = list(self.tries)
+        self.saved_wins = list(self.wins)
+        self.children = [None]*len(options)
+
+    def options(self):
+        return list(zip(self.states, self.winners))
+
+    def child(self, i):
+        child = self.children[i]
+        if child is None:
+            child = Node(self.states[i], self.child_names, moved=True)
+            self.children[i] = child
+        return child
+
+    def find_child(self, state):
+        """Child node of the option to state, None if never descended into."""
+        try:
+            return self.children[self.states.index(state)]
+        except (TypeError, ValueError):
+            return None
+
+    def select_uct(self, c):
+        """Index of the first untried option, else of the highest UCT value."""
+        tries = self.tries
+        if 0 in tries:
+            return tries.index(0)
+        log_total = math.log(sum(tries))
+        exponent = 1/c
+        selection = 0
+        max_uct = -1
+        for i, (n, w) in enumerate(zip(tries, self.wins)):
+            uct = w/n + math.pow(log_total/n, exponent)
+            if uct > max_uct:
+                selection = i
+                max_uct = uct
+        return selection
+
+    def greedy(self, states):
+        """State among states with the highest win rate, else the first."""
+        index = {state: i for i, state in enumerate(self.states)}
+        max_val = 0
+        selection = states[0]
+        for state in states:
+            i = index[state]
+            if self.tries[i] and self.wins[i]/self.tries[i] > max_val:
+                selection = state
+                max_val = self.wins[i]/self.tries[i]
+        return selection
+
+    def settled(self, remaining):
+        """Whether remaining playouts cannot change the greedy choice.
+
+        True if no other option could reach the win rate of the best one,
+        even if all remaining playouts went to it and won while those of
+        the best one lost.
+        """
+        if self.win is not None or len(self.states) < 2:
+            return True
+        rates = [w/n if n else 0 for n, w in zip(self.tries, self.wins)]
+        best = rates.index(max(rates))
+        low = self.wins[best]/(self.tries[best] + remaining)
+        for i, (n, w) in enumerate(zip(self.tries, self.wins)):
+            if i != best and (w + remaining)/(n + remaining) >= low:
+                return False
+        return True
+
+    def export(self, tree):
+        """Merge tries and wins gathered since the last export into tree."""
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            if not node.expanded():
+                continue
+            for i, state in enumerate(node.states):
+                tries = node.tries[i] - node.saved_tries[i]
+                if tries:
+                    tree.merge(state, tries, node.wins[i] - node.saved_wins[i])
+            node.saved_tries = list(node.tries)
+            node.saved_wins = list(node.wins)
+            nodes.extend(child for child in node.children if child is not None)
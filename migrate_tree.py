@@ -0,0 +1,26 @@
+import click
+
+import serialize
+from factory import serializer_factory
+
+
+@click.command()
+@click.option("--format", "-f", "format", default="mongo")
+@click.option("--db", default="santorini")
+@click.option("--collection", default="tree")
+@click.option("--target-collection", "target_collection", default="packed_tree")
+@click.option("--keys", "key_format", default="bytes",
+              type=click.Choice(["string", "bytes"]))
+def main(format, db, collection, target_collection, key_format):
+    """Copy a Mongo tree into a new collection with another key format."""
+    with serializer_factory.get_serializer(format, db=db,
+                                           collection=collection) as source:
+        with serializer_factory.get_serializer(
+                format, db=db, collection=target_collection,
+                key_format=key_format) as target:
+            n = serialize.copy_tree(source, target)
+    print("Copied {:d} states".format(n))
+
+
+if __name__ == '__main__':
+    main()
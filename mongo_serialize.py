@@ -1,15 +1,27 @@
+import collections
 import copy
+import queue
 import sys
+import threading
+import time
+
 import pymongo
 
 import core
 import serialize
 
 
+FLUSH_QUEUE = 8  # flushes waiting before flush() blocks
+
+
 class MongoTree(serialize.Tree):
+    key_formats = ("string", "bytes", "zobrist")
 
     def __init__(self, cnxn_str="mongodb://localhost:27017/", db="santorini",
-                 collection="tree"):
+                 collection="tree", key_format=None, canonical=False,
+                 verify=False):
+        super().__init__(key_format=key_format, canonical=canonical,
+                         verify=verify)
         self.client = pymongo.MongoClient(cnxn_str, connect=False)
         self.db = self.client[db]
         self.tree = self.db[collection]
@@ -17,33 +29,47 @@ class MongoTree(serialize.Tree):
     def __exit__(self, type, value, traceback):
         self.client.close()
 
-    def __contains__(self, state):
-        if self.tree.find_one({"_id": state}):
+    def _contains(self, key):
+        if self.tree.find_one({"_id": key}):
             return True
         else:
             return False
 
-    def __getitem__(self, state):
-        if state in self:
-            return self.tree.find_one({"_id": state})
+    def _get(self, key):
+        record = self.tree.find_one({"_id": key})
+        if record:
+            return record
         else:
             raise KeyError
 
-    def insert_state(self, state):
+    def _get_many(self, keys):
+        records = {record["_id"]: record for record
+                   in self.tree.find({"_id": {"$in": list(set(keys))}})}
+        return [records.get(key) for key in keys]
+
+    def items(self):
+        for record in self.tree.find():
+            yield self.decode(record["_id"]), record
+
+    def _insert(self, key):
         try:
-            record = {"_id": state, "tries": 0, "wins": 0, "options": []}
+            record = {"_id": key, "tries": 0, "wins": 0, "options": []}
             self.tree.insert_one(record)
         except pymongo.errors.DuplicateKeyError:
             pass
 
-    def _add_try(self, state):
-        self.tree.update_one({"_id": state}, {"$inc": {"tries": 1}})
+    def _add_try(self, key):
+        self.tree.update_one({"_id": key}, {"$inc": {"tries": 1}})
+
+    def _add_win(self, key):
+        self.tree.update_one({"_id": key}, {"$inc": {"wins": 1}})
 
-    def add_win(self, state):
-        self.tree.update_one({"_id": state}, {"$inc": {"wins": 1}})
+    def _set_options(self, key, options):
+        self.tree.update_one({"_id": key}, {"$set": {"options": options}})
 
-    def _set_options(self, state, options):
-        self.tree.update_one({"_id": state}, {"$set": {"options": options}})
+    def _merge(self, key, tries, wins):
+        self.tree.update_one({"_id": key},
+                             {"$inc": {"tries": tries, "wins": wins}})
 
     def sample(self, n):
         for r in self.tree.aggregate([{"$sample": {"size": n}}]):
@@ -51,65 +77,305 @@ class MongoTree(serialize.Tree):
 
 
 class BulkMongoTree(MongoTree):
+    """A MongoTree buffering updates in memory and writing them in bulk.
+
+    Updates are written when states are evicted and on exit. With
+    flush_states or flush_seconds, they are also handed to a background
+    thread once that many states are buffered or seconds have passed since
+    the last flush, while their records stay cached. ordered=False lets Mongo
+    apply the operations of a bulk_write in any order, and in parallel.
+
+    Updates a failed bulk_write did not apply are buffered again, and the
+    error is raised by the next flush, write or read from the collection.
+    """
 
     def __init__(self, cnxn_str="mongodb://localhost:27017/", db="santorini",
-                 collection="tree"):
+                 collection="tree", key_format=None, canonical=False,
+                 verify=False, max_states=None, eviction="lru",
+                 flush_states=None, flush_seconds=None, ordered=True):
         self.dict = {}
         self.updates = {}
         self.options = {}
-        super().__init__(cnxn_str=cnxn_str, db=db, collection=collection)
+        super().__init__(cnxn_str=cnxn_str, db=db, collection=collection,
+                         key_format=key_format, canonical=canonical,
+                         verify=verify)
+        self.set_bound(max_states, eviction)
+        self.flush_states = flush_states
+        self.flush_seconds = flush_seconds
+        self.ordered = ordered
+        self.last_flush = time.time()
+        self.flush_queue = queue.Queue(FLUSH_QUEUE)
+        self.queued = collections.Counter()  # queued flushes per state
+        self.flushed = threading.Condition()
+        self.flush_thread = None
+        self.flush_error = None
+        self.failed = []  # (state, increments, options) a flush did not apply
+        self.flush_stats = {"flushes": 0, "states": 0, "seconds": 0.0,
+                            "max_seconds": 0.0}
 
     def __exit__(self, type, value, traceback):
-        self.write()
-        super().__exit__(type, value, traceback)
+        try:
+            self.write()
+        finally:
+            self.stop_flushing()
+            super().__exit__(type, value, traceback)
 
-    def __contains__(self, state):
-        if state in self.dict:
+    def _contains(self, key):
+        if key in self.dict:
             return True
-        elif self.tree.find_one({"_id": state}):
-            self.insert_state(state)
+        self._wait_flushed([key])
+        record = self.tree.find_one({"_id": key})
+        if record or key in self.updates:
+            self._load(key, record)
+            self._check_bound(key)
             return True
         else:
             return False
 
-    def __getitem__(self, state):
+    def _load(self, key, record):
+        """Cache the stored record of key, None if not stored, with its
+        buffered updates."""
+        if record is None:
+            record = {"tries": 0, "wins": 0, "options": []}
         try:
-            return self.dict[state]
+            update = self.updates[key]
         except KeyError:
-            if state in self:
-                self.dict[state] = self.tree.find_one({"_id": state})
-                self.updates[state] = {"tries": 0, "wins": 0}
-                return self.dict[state]
-            else:
-                raise KeyError
-
-    def insert_state(self, state):
-        self.dict[state] = {"tries": 0, "wins": 0, "options": []}
-        self.updates[state] = {"tries": 0, "wins": 0}
-
-    def _add_try(self, state):
-        self.dict[state]["tries"] += 1
-        self.updates[state]["tries"] += 1
-
-    def add_win(self, state):
-        self.dict[state]["wins"] += 1
-        self.updates[state]["wins"] += 1
-
-    def _set_options(self, state, options):
-        self.dict[state]["options"] = options
-        self.options[state] = options
-
-    def write(self):
-        updates = []
-        for state, keys in self.updates.items():
-            update_dict = {"$inc": keys}
-            try:
-                update_dict["$set"] = {"options": self.options[state]}
-            except KeyError:
-                pass
-            update = pymongo.UpdateOne({"_id": state}, update_dict, upsert=True)
-            updates.append(update)
-        if updates:
-            self.tree.bulk_write(updates)
-        self.dict = {}
-        self.updates = {}
+            pass
+        else:
+            # updates of an evicted state buffered again after a failed flush
+            record["tries"] += update["tries"]
+            record["wins"] += update["wins"]
+            if key in self.options:
+                record["options"] = self.options[key]
+        self.dict[key] = record
+
+    def _resident(self):
+        return self.dict
+
+    def _evict(self, keys):
+        self.write(keys)
+
+    def _get(self, key):
+        if not self._contains(key):
+            raise KeyError(key)
+        self._touch(key)
+        return self.dict[key]
+
+    def _get_many(self, keys):
+        missing = [key for key in keys if key not in self.dict]
+        if missing:
+            self._wait_flushed(missing)
+            for key, record in zip(missing, super()._get_many(missing)):
+                if record is not None or key in self.updates:
+                    self._load(key, record)
+        records = [self.dict.get(key) for key in keys]
+        for key, record in zip(keys, records):
+            if record is not None:
+                self._touch(key)
+        # evict only once the records of all keys are taken
+        self._check_bound(None)
+        return records
+
+    def items(self):
+        self.write()
+        return super().items()
+
+    def _pending(self, key):
+        """Buffered increments of key."""
+        try:
+            return self.updates[key]
+        except KeyError:
+            update = self.updates[key] = {"tries": 0, "wins": 0}
+            return update
+
+    def _insert(self, key):
+        self._load(key, None)
+        self._pending(key)
+        self._check_bound(key)
+
+    def _add_try(self, key):
+        self._touch(key)
+        self.dict[key]["tries"] += 1
+        self._pending(key)["tries"] += 1
+        self._check_flush()
+
+    def _add_win(self, key):
+        self.dict[key]["wins"] += 1
+        self._pending(key)["wins"] += 1
+
+    def _set_options(self, key, options):
+        self.dict[key]["options"] = options
+        self.options[key] = options
+        self._pending(key)
+        self._check_flush()
+
+    def _merge(self, key, tries, wins):
+        self.dict[key]["tries"] += tries
+        self.dict[key]["wins"] += wins
+        update = self._pending(key)
+        update["tries"] += tries
+        update["wins"] += wins
+        self._check_flush()
+
+    def _batch(self, keys):
+        """(state, increments, options) of the buffered updates of keys,
+        clearing them. Options are None when not set."""
+        return [(key, self.updates.pop(key), self.options.pop(key, None))
+                for key in keys]
+
+    @staticmethod
+    def _operations(batch):
+        operations = []
+        for state, increments, options in batch:
+            update_dict = {"$inc": increments}
+            if options is not None:
+                update_dict["$set"] = {"options": options}
+            operations.append(
+                pymongo.UpdateOne({"_id": state}, update_dict, upsert=True))
+        return operations
+
+    def _bulk_write(self, batch):
+        """Write batch, returning the updates it did not apply and the error."""
+        try:
+            self.tree.bulk_write(self._operations(batch), ordered=self.ordered)
+        except pymongo.errors.BulkWriteError as e:
+            indices = [error["index"] for error in e.details["writeErrors"]]
+            if self.ordered:
+                # an ordered write stops at its first error
+                return batch[min(indices):], e
+            return [batch[i] for i in sorted(set(indices))], e
+        except Exception as e:
+            return batch, e
+        return [], None
+
+    def _rebuffer(self, failed):
+        """Buffer the updates a failed write did not apply again.
+
+        Options set since are newer and kept.
+        """
+        for key, increments, options in failed:
+            update = self._pending(key)
+            update["tries"] += increments["tries"]
+            update["wins"] += increments["wins"]
+            if options is not None:
+                self.options.setdefault(key, options)
+
+    def write(self, keys=None):
+        """Write the updates of keys, by default of all states, and drop them.
+
+        Writing all states waits for the flush thread to finish.
+        """
+        wait = keys is None
+        if wait:
+            keys = list(self.dict)
+            pending = list(self.updates)
+        else:
+            pending = [key for key in keys if key in self.updates]
+        batch = self._batch(pending)
+        for key in keys:
+            del self.dict[key]
+        if self.flush_thread:
+            if batch:
+                self._enqueue(batch)
+            if wait:
+                self.flush_queue.join()
+            self._raise_flush_error()
+        elif batch:
+            failed, error = self._bulk_write(batch)
+            if error:
+                self._rebuffer(failed)
+                raise error
+
+    def _check_flush(self):
+        if self.flush_states and len(self.updates) >= self.flush_states:
+            self.flush()
+        elif (self.flush_seconds
+              and time.time() - self.last_flush >= self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        """Hand the buffered updates to the flush thread, keeping records."""
+        self._raise_flush_error()
+        self.last_flush = time.time()
+        batch = self._batch(list(self.updates))
+        if not batch:
+            return
+        if not self.flush_thread:
+            self.flush_thread = threading.Thread(target=self._flush_loop,
+                                                 daemon=True)
+            self.flush_thread.start()
+        self._enqueue(batch)
+
+    def _enqueue(self, batch):
+        with self.flushed:
+            self.queued.update(key for key, _, _ in batch)
+        self.flush_queue.put(batch)
+
+    def _release(self, keys):
+        """Count the queued updates of keys as flushed. Holds self.flushed."""
+        self.queued.subtract(keys)
+        for key in keys:
+            if self.queued[key] <= 0:
+                del self.queued[key]
+        self.flushed.notify_all()
+
+    def _wait_flushed(self, keys):
+        """Wait until queued updates of keys are written, before reading them.
+
+        Raises the error of a failed flush, as its states stay queued until
+        their updates are buffered again.
+        """
+        if not self.queued:
+            return
+        with self.flushed:
+            self.flushed.wait_for(
+                lambda: self.flush_error is not None
+                or not any(key in self.queued for key in keys))
+        self._raise_flush_error()
+
+    def _flush_loop(self):
+        while True:
+            item = self.flush_queue.get()
+            if item is None:
+                self.flush_queue.task_done()
+                return
+            start = time.time()
+            failed, error = self._bulk_write(item)
+            failed_keys = {key for key, _, _ in failed}
+            with self.flushed:
+                if error:
+                    # failed states stay queued until buffered again
+                    self.failed.extend(failed)
+                    self.flush_error = error
+                self._release([key for key, _, _ in item
+                               if key not in failed_keys])
+            seconds = time.time() - start
+            stats = self.flush_stats
+            stats["flushes"] += 1
+            stats["states"] += len(item) - len(failed)
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            self.flush_queue.task_done()
+
+    def _raise_flush_error(self):
+        """Buffer the updates of failed flushes again and raise the error."""
+        if self.flush_error is None:
+            return
+        with self.flushed:
+            error, self.flush_error = self.flush_error, None
+            failed, self.failed = self.failed, []
+            self._rebuffer(failed)
+            self._release([key for key, _, _ in failed])
+        raise error
+
+    @property
+    def queue_depth(self):
+        """Number of flushes waiting for the flush thread."""
+        return self.flush_queue.unfinished_tasks
+
+    def stop_flushing(self):
+        """Stop the flush thread once it has written the queued updates."""
+        if self.flush_thread:
+            self.flush_queue.put(None)
+            self.flush_thread.join()
+            self.flush_thread = None
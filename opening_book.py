@@ -0,0 +1,50 @@
+import json
+import os
+
+import symmetry
+
+
+class OpeningBook(object):
+    """Setup choices found by search, keyed by the state before the setup.
+
+    Entries are stored under canonical states, so one search serves all
+    symmetric positions.
+    """
+
+    def __init__(self, filepath="opening_book.json"):
+        self.filepath = filepath
+        self.book = {}
+
+    def __enter__(self):
+        self.load()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.save()
+
+    def load(self):
+        if os.path.exists(self.filepath):
+            with open(self.filepath) as jsonin:
+                self.book.update(json.load(jsonin))
+
+    def save(self):
+        # merge with entries other processes saved meanwhile
+        book = self.book
+        self.book = {}
+        self.load()
+        self.book.update(book)
+        with open(self.filepath, "w") as jsonout:
+            json.dump(self.book, jsonout)
+
+    def __contains__(self, state):
+        return symmetry.canonical(state)[0] in self.book
+
+    def __getitem__(self, state):
+        canonical_state, t = symmetry.canonical(state)
+        selection = self.book[canonical_state]
+        return symmetry.transform(
+            selection, symmetry.inverse(t, symmetry.board_size(state)))
+
+    def __setitem__(self, state, selection):
+        canonical_state, t = symmetry.canonical(state)
+        self.book[canonical_state] = symmetry.transform(selection, t)
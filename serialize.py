@@ -1,7 +1,38 @@
+import functools
+import heapq
+import itertools
+
+import codec
+import symmetry
+import zobrist
+
+
+EVICTIONS = ("lru", "visits")
+EVICT_FRACTION = 0.1  # of max_states evicted at once
+
+
 class Tree(object):
+    key_formats = ("string", "int", "bytes", "zobrist")
 
-    def __init__(self):
+    def __init__(self, key_format=None, canonical=False, verify=False,
+                 max_states=None, eviction="lru"):
+        if key_format and key_format not in self.key_formats:
+            raise ValueError(key_format)
         self.tree = {}
+        self.set_bound(max_states, eviction)
+        self.key_format = key_format
+        self.canonical = canonical
+        self.verify = verify
+        self.encode_key, self.decode = codec.get_codec(key_format)
+        if key_format == "zobrist" and verify:
+            verifier = zobrist.StateVerifier()
+            self.encode_key = verifier
+            self.decode = verifier.states.__getitem__
+        if canonical:
+            self.encode = functools.partial(symmetry.canonical_key,
+                                            self.encode_key)
+        else:
+            self.encode = self.encode_key
 
     def __enter__(self):
         return self
@@ -10,29 +41,182 @@ class Tree(object):
         pass
 
     def __contains__(self, state):
-        return state in self.tree.keys()
+        return self._contains(self.encode(state))
+
+    def __getitem__(self, state):
+        if not self.canonical:
+            return self._get(self.encode(state))
+        state, t = symmetry.canonical(state)
+        record = self._get(self.encode_key(state))
+        if t and record.get("options"):
+            record = dict(record)
+            record["options"] = symmetry.transform_options(
+                record["options"], symmetry.inverse(t, symmetry.board_size(state)))
+        return record
+
+    def get_many(self, states):
+        """Records of states in one lookup, None for states not in the tree."""
+        if not self.canonical:
+            return self._get_many([self.encode(state) for state in states])
+        canonicals = [symmetry.canonical(state) for state in states]
+        records = self._get_many([self.encode_key(state)
+                                  for state, _ in canonicals])
+        for i, (state, t) in enumerate(canonicals):
+            record = records[i]
+            if t and record and record.get("options"):
+                record = dict(record)
+                record["options"] = symmetry.transform_options(
+                    record["options"],
+                    symmetry.inverse(t, symmetry.board_size(state)))
+                records[i] = record
+        return records
+
+    def game_key(self, game):
+        """Key of the position of game, without a state string if possible."""
+        if self.key_format == "zobrist" and not (self.canonical or self.verify):
+            return game.state_hash()
+        return self.encode(game.compact_state())
+
+    def get_key(self, key):
+        return self._get(key)
+
+    def set_bound(self, max_states=None, eviction="lru"):
+        """Hold at most max_states records in memory, evicting by eviction.
+
+        "lru" evicts the states least recently looked up or tried first,
+        "visits" the states with the fewest tries.
+        """
+        if eviction not in EVICTIONS:
+            raise ValueError(eviction)
+        self.max_states = max_states
+        self.eviction = eviction
+        self.evictions = 0
+
+    @property
+    def resident_states(self):
+        """Number of records held in memory."""
+        return len(self._resident())
+
+    def _resident(self):
+        """Dict of the records held in memory, in order of use."""
+        return self.tree
+
+    def _touch(self, key):
+        if self.max_states and self.eviction == "lru":
+            resident = self._resident()
+            resident[key] = resident.pop(key)
+
+    def _check_bound(self, keep):
+        """Evict states, but not keep, once there are more than max_states."""
+        resident = self._resident()
+        if not self.max_states or len(resident) <= self.max_states:
+            return
+        n = len(resident) - int(self.max_states*(1 - EVICT_FRACTION))
+        candidates = (key for key in resident if key != keep)
+        if self.eviction == "lru":
+            keys = list(itertools.islice(candidates, n))
+        else:
+            keys = heapq.nsmallest(n, candidates, key=self._resident_tries)
+        self._evict(keys)
+        self.evictions += len(keys)
 
-    def __getitem__(self, key):
+    def _resident_tries(self, key):
+        return self._resident()[key]["tries"]
+
+    def _evict(self, keys):
+        for key in keys:
+            del self.tree[key]
+
+    def _contains(self, key):
+        return key in self.tree
+
+    def _get(self, key):
+        self._touch(key)
         return self.tree[key]
 
+    def _get_many(self, keys):
+        records = []
+        for key in keys:
+            try:
+                records.append(self._get(key))
+            except KeyError:
+                records.append(None)
+        return records
+
+    def items(self):
+        """Iterate over (state, record) pairs."""
+        for key, record in self.tree.items():
+            yield self.decode(key), record
+
     def insert_state(self, state):
-        self.tree[state] = {"tries": 0, "wins": 0, "options": []}
+        self._insert(self.encode(state))
+
+    def _insert(self, key):
+        self.tree[key] = {"tries": 0, "wins": 0, "options": []}
+        self._check_bound(key)
 
     def add_try(self, state):
-        if state not in self:
-            self.insert_state(state)
-        self._add_try(state)
+        self.add_try_key(self.encode(state))
 
-    def _add_try(self, state):
-        self.tree[state]["tries"] += 1
+    def add_try_key(self, key):
+        if not self._contains(key):
+            self._insert(key)
+        self._add_try(key)
+
+    def _add_try(self, key):
+        self._touch(key)
+        self.tree[key]["tries"] += 1
 
     def add_win(self, state):
-        self.tree[state]["wins"] += 1
+        self._add_win(self.encode(state))
+
+    def add_win_key(self, key):
+        self._add_win(key)
+
+    def _add_win(self, key):
+        self.tree[key]["wins"] += 1
 
     def set_options(self, state, options):
-        if state not in self:
-            self.insert_state(state)
-        self._set_options(state, options)
+        key, options = self._options_key(state, options)
+        if not self._contains(key):
+            self._insert(key)
+        self._set_options(key, options)
+
+    def _set_options(self, key, options):
+        self.tree[key]["options"] = options
+
+    def merge(self, state, tries, wins, options=None):
+        """Add tries and wins to state, e.g. when copying another tree."""
+        key, options = self._options_key(state, options)
+        if not self._contains(key):
+            self._insert(key)
+        self._merge(key, tries, wins)
+        if options:
+            self._set_options(key, options)
+
+    def _merge(self, key, tries, wins):
+        self.tree[key]["tries"] += tries
+        self.tree[key]["wins"] += wins
+
+    def _options_key(self, state, options):
+        """Key of state and its options in the orientation stored under it."""
+        if not self.canonical:
+            return self.encode(state), options
+        state, t = symmetry.canonical(state)
+        if options:
+            options = symmetry.transform_options(options, t)
+        return self.encode_key(state), options
+
+
+def copy_tree(source, target):
+    """Merge every record of source into target, return the number of states.
 
-    def _set_options(self, state, options):
-        self.tree[state]["options"] = options
+    Copying into a target with another key_format migrates existing trees,
+    e.g. from state strings to packed keys.
+    """
+    n = 0
+    for state, record in source.items():
+        target.merge(state, record["tries"], record["wins"],
+                     record.get("options"))
+        n += 1
+    return n
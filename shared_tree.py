@@ -0,0 +1,174 @@
+"""Tree statistics in shared memory for tree-parallel search.
+
+Processes attached to the same SharedTree add tries and wins to one set of
+arrays, indexed by slot. Keys are zobrist hashes of states, placed in an
+open addressing table, so the empty board, which hashes to 0, marks free
+slots. Virtual losses count the searches currently below a state, so
+concurrent searches spread over different paths. Updates of a slot hold one
+of LOCKS locks, picked by slot, so workers updating different states rarely
+wait on each other.
+
+A shared tree lives for one search: only the statistics of the root options
+are copied back to the tree of the searching player, the deeper states are
+dropped with the shared memory.
+"""
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import serialize
+
+
+CAPACITY = 1 << 18
+FIELDS = 4  # keys, tries, wins, virtual losses
+LOCKS = 64
+
+
+def start_tracker():
+    """Start the resource tracker before starting worker processes.
+
+    Workers then share it, otherwise each worker would track the trees it
+    attaches to and unlink them when it exits.
+    """
+    resource_tracker.ensure_running()
+
+
+def make_locks(n=LOCKS):
+    """Locks for the slots of SharedTrees, to hand to worker processes."""
+    return tuple(multiprocessing.Lock() for _ in range(n))
+
+
+class SharedTree(serialize.Tree):
+    key_formats = ("zobrist",)
+
+    def __init__(self, capacity=CAPACITY, name=None, locks=None):
+        """Create arrays for capacity states, or attach to those named name.
+
+        Processes sharing a tree must share its locks, see make_locks.
+        """
+        super().__init__(key_format="zobrist")
+        self.capacity = capacity
+        self.locks = locks or make_locks()
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=FIELDS*8*capacity)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        arrays = np.ndarray((FIELDS, capacity), dtype=np.int64,
+                            buffer=self.shm.buf)
+        if self.owner:
+            arrays[:] = 0
+        self.keys, self.tries, self.wins, self.virtual = arrays
+        self.slots = {}
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.keys = self.tries = self.wins = self.virtual = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def lock(self, slot):
+        return self.locks[slot % len(self.locks)]
+
+    def _slot(self, key, insert=False):
+        """Slot of key, -1 if key is missing or the table is full."""
+        try:
+            return self.slots[key]
+        except KeyError:
+            pass
+        keys = self.keys
+        slot = key % self.capacity
+        for _ in range(self.capacity):
+            found = keys[slot]
+            if found == 0 and insert:
+                with self.lock(slot):
+                    found = keys[slot]
+                    if found == 0:
+                        keys[slot] = found = key
+            if found == key:
+                self.slots[key] = slot
+                return slot
+            if found == 0:
+                return -1
+            slot = (slot + 1) % self.capacity
+        return -1
+
+    def _contains(self, key):
+        return self._slot(key) >= 0
+
+    def _get(self, key):
+        slot = self._slot(key)
+        if slot < 0:
+            raise KeyError(key)
+        return {"tries": int(self.tries[slot]), "wins": int(self.wins[slot]),
+                "options": []}
+
+    def items(self):
+        for slot in np.flatnonzero(self.keys):
+            key = int(self.keys[slot])
+            yield self.decode(key), self._get(key)
+
+    def _insert(self, key):
+        self._slot(key, insert=True)
+
+    def _add_try(self, key):
+        self._merge(key, 1, 0)
+
+    def _add_win(self, key):
+        self._merge(key, 0, 1)
+
+    def _set_options(self, key, options):
+        pass
+
+    def _merge(self, key, tries, wins):
+        slot = self._slot(key, insert=True)
+        if slot < 0:
+            return
+        with self.lock(slot):
+            self.tries[slot] += tries
+            self.wins[slot] += wins
+
+    def add_virtual_loss(self, key):
+        """Count a search below key, return whether it is the first visit."""
+        slot = self._slot(key, insert=True)
+        if slot < 0:
+            return True
+        with self.lock(slot):
+            self.virtual[slot] += 1
+            return self.tries[slot] + self.virtual[slot] == 1
+
+    def backup(self, keys, wins):
+        """Turn the virtual losses of keys into tries, adding a win per flag."""
+        slots = [self._slot(key) for key in keys]
+        for slot, win in zip(slots, wins):
+            if slot >= 0:
+                with self.lock(slot):
+                    self.virtual[slot] -= 1
+                    self.tries[slot] += 1
+                    self.wins[slot] += win
+
+    def select_uct(self, keys, c):
+        """Index of the first untried key, else of the highest UCT value.
+
+        Virtual losses count as tries without wins.
+        """
+        slots = np.array([self._slot(key) for key in keys])
+        known = slots >= 0
+        n = np.zeros(len(keys))
+        w = np.zeros(len(keys))
+        n[known] = self.tries[slots[known]] + self.virtual[slots[known]]
+        w[known] = self.wins[slots[known]]
+        untried = np.flatnonzero(n == 0)
+        if len(untried):
+            return int(untried[0])
+        uct = w/n + np.power(np.log(n.sum())/n, 1/c)
+        return int(uct.argmax())
@@ -1,7 +1,8 @@
-from sqlalchemy import create_engine
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import create_engine, event, func, inspect, select, text
+from sqlalchemy import (JSON, BigInteger, Column, Integer, LargeBinary,
+                        String)
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
 import serialize
 
@@ -15,49 +16,215 @@ class State(Base):
     state = Column(String, primary_key=True)
     tries = Column(Integer)
     wins = Column(Integer)
+    options = Column(JSON(none_as_null=True))
 
 
-class SQLTree(serialize.Tree):
+class PackedState(Base):
+    __tablename__ = "packed_states"
+
+    state = Column(LargeBinary, primary_key=True)
+    tries = Column(Integer)
+    wins = Column(Integer)
+    options = Column(JSON(none_as_null=True))
+
+
+class HashedState(Base):
+    __tablename__ = "hashed_states"
+
+    state = Column(BigInteger, primary_key=True)
+    tries = Column(Integer)
+    wins = Column(Integer)
+    options = Column(JSON(none_as_null=True))
 
-    def __init__(self, cnxn_str="sqlite:///santorini.db"):
+
+KEY_MODELS = {"bytes": PackedState, "zobrist": HashedState}
+IN_BATCH = 500  # keys per IN (...) query, below SQLite's variable limit
+FLUSH_STATES = 10000
+UPSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",  # KiB
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+class SQLTree(serialize.Tree):
+    """A tree in a SQL table, written through a buffer of increments.
+
+    Records read are cached, with None for states missing from the table,
+    and increments are added to both the cache and the buffer. Once
+    flush_states states are buffered, and on exit, the buffer is written
+    with one INSERT ... ON CONFLICT DO UPDATE per state in a single
+    executemany.
+    """
+    key_formats = ("string", "bytes", "zobrist")
+
+    def __init__(self, cnxn_str="sqlite:///santorini.db", key_format=None,
+                 canonical=False, verify=False, db=None, max_states=None,
+                 eviction="lru", flush_states=FLUSH_STATES):
+        super().__init__(key_format=key_format, canonical=canonical,
+                         verify=verify, max_states=max_states,
+                         eviction=eviction)
+        if db:
+            cnxn_str = "sqlite:///{:s}.db".format(db)
+        self.model = KEY_MODELS.get(key_format, State)
+        self.table = self.model.__table__
         self.engine = create_engine(cnxn_str)
-        self.session = sessionmaker(bind=self.engine)()
+        if self.engine.dialect.name == "sqlite":
+            event.listen(self.engine, "connect", set_sqlite_pragmas)
+        try:
+            self.upsert = UPSERTS[self.engine.dialect.name]
+        except KeyError:
+            raise ValueError(self.engine.dialect.name)
+        self.flush_states = flush_states
+        self.cache = {}
+        self.updates = {}
+        self.options = {}
 
     def __enter__(self):
         Base.metadata.create_all(self.engine)
+        columns = {column["name"] for column
+                   in inspect(self.engine).get_columns(self.table.name)}
+        if "options" not in columns:
+            # tables created before options were stored
+            with self.engine.begin() as connection:
+                connection.execute(text("ALTER TABLE {:s} ADD COLUMN options "
+                                        "JSON".format(self.table.name)))
         return self
 
     def __exit__(self, type, value, traceback):
         try:
-            self.session.commit()
-        except:
-            self.session.rollback()
-            raise
+            self.flush()
         finally:
-            self.session.close()
-
-    def __contains__(self, state):
-        if self.session.query(State).filter_by(state=state).one_or_none():
-            return True
-        else:
-            return False
-
-    def __getitem__(self, state):
+            self.engine.dispose()
+
+    def _resident(self):
+        return self.cache
+
+    def _evict(self, keys):
+        self.flush([key for key in keys if key in self.updates])
+        for key in keys:
+            del self.cache[key]
+
+    def _resident_tries(self, key):
+        record = self.cache[key]
+        return record["tries"] if record else 0
+
+    @staticmethod
+    def _record(row):
+        # JSON stores (state, winner) options as lists
+        return {"tries": row.tries, "wins": row.wins,
+                "options": [tuple(option) for option in row.options or []]}
+
+    def _fetch(self, keys):
+        """Cache the records of keys, None for keys not in the table."""
+        unique_keys = list(set(keys))
+        for key in unique_keys:
+            self.cache[key] = None
+        with self.engine.connect() as connection:
+            for start in range(0, len(unique_keys), IN_BATCH):
+                batch = unique_keys[start:start + IN_BATCH]
+                query = select(self.table).where(self.table.c.state.in_(batch))
+                for row in connection.execute(query):
+                    self.cache[row.state] = self._record(row)
+
+    def _contains(self, key):
+        if key not in self.cache:
+            self._fetch([key])
+            self._check_bound(key)
+        return self.cache[key] is not None
+
+    def _get(self, key):
+        if not self._contains(key):
+            raise KeyError(key)
+        self._touch(key)
+        return self.cache[key]
+
+    def _get_many(self, keys):
+        missing = [key for key in keys if key not in self.cache]
+        if missing:
+            self._fetch(missing)
+        records = [self.cache.get(key) for key in keys]
+        self._check_bound(None)
+        return records
+
+    def items(self):
+        self.flush()
+        with self.engine.connect() as connection:
+            rows = connection.execution_options(yield_per=1000).execute(
+                select(self.table))
+            for row in rows:
+                yield self.decode(row.state), self._record(row)
+
+    def _pending(self, key):
+        """Buffered [tries, wins] increments of key."""
         try:
-            sql_state = self.session.query(State).filter_by(state=state).one()
-            return sql_state.__dict__
-        except:
-            raise KeyError
-
-    def insert_state(self, state):
-        sql_state = State(state=state, tries=0, wins=0)
-        self.session.add(sql_state)
-        return sql_state
-
-    def _add_try(self, state):
-        sql_state = self.session.query(State).filter_by(state=state).one()
-        sql_state.tries += 1
-
-    def add_win(self, state):
-        sql_state = self.session.query(State).filter_by(state=state).one()
-        sql_state.wins += 1
+            return self.updates[key]
+        except KeyError:
+            update = self.updates[key] = [0, 0]
+            return update
+
+    def _insert(self, key):
+        self.cache[key] = {"tries": 0, "wins": 0, "options": []}
+        self._pending(key)
+        self._check_bound(key)
+
+    def _add_try(self, key):
+        self._touch(key)
+        self.cache[key]["tries"] += 1
+        self._pending(key)[0] += 1
+        self._check_flush()
+
+    def _add_win(self, key):
+        self.cache[key]["wins"] += 1
+        self._pending(key)[1] += 1
+
+    def _set_options(self, key, options):
+        self.cache[key]["options"] = options
+        self.options[key] = options
+        self._pending(key)
+        self._check_flush()
+
+    def _merge(self, key, tries, wins):
+        record = self.cache[key]
+        record["tries"] += tries
+        record["wins"] += wins
+        update = self._pending(key)
+        update[0] += tries
+        update[1] += wins
+        self._check_flush()
+
+    def _check_flush(self):
+        if self.flush_states and len(self.updates) >= self.flush_states:
+            self.flush()
+
+    def flush(self, keys=None):
+        """Write the buffered increments of keys, by default of all states."""
+        if keys is None:
+            keys = list(self.updates)
+        if not keys:
+            return
+        rows = []
+        for key in keys:
+            tries, wins = self.updates.pop(key)
+            rows.append({"state": key, "tries": tries, "wins": wins,
+                         "options": self.options.pop(key, None)})
+        statement = self.upsert(self.table)
+        excluded = statement.excluded
+        statement = statement.on_conflict_do_update(
+            index_elements=[self.table.c.state],
+            set_={"tries": self.table.c.tries + excluded.tries,
+                  "wins": self.table.c.wins + excluded.wins,
+                  "options": func.coalesce(excluded.options,
+                                           self.table.c.options)})
+        with self.engine.begin() as connection:
+            connection.execute(statement, rows)
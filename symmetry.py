@@ -0,0 +1,89 @@
+"""Dihedral symmetries of compact game states.
+
+Rotating or reflecting the board gives an equivalent position. The canonical
+form of a state is the smallest string among its 8 symmetric states, so all
+equivalent positions share one tree entry.
+"""
+import operator
+
+
+_transforms = {}
+
+
+def transforms(size):
+    """Index permutations of the 8 board symmetries, identity first.
+
+    A transformed state takes the space at perm[i] of the original state as
+    its space i.
+    """
+    try:
+        return _transforms[size]
+    except KeyError:
+        pass
+    n = size - 1
+    maps = [
+        lambda x, y: (x, y),
+        lambda x, y: (n - y, x),
+        lambda x, y: (n - x, n - y),
+        lambda x, y: (y, n - x),
+        lambda x, y: (n - x, y),
+        lambda x, y: (x, n - y),
+        lambda x, y: (y, x),
+        lambda x, y: (n - y, n - x),
+    ]
+    perms = []
+    for f in maps:
+        perm = [None]*size**2
+        for y in range(size):
+            for x in range(size):
+                fx, fy = f(x, y)
+                perm[fy*size + fx] = y*size + x
+        perms.append(tuple(perm))
+    inverses = []
+    for perm in perms:
+        inverse = tuple(perm.index(i) for i in range(size**2))
+        inverses.append(perms.index(inverse))
+    getters = [operator.itemgetter(*(perm + tuple(i + size**2 for i in perm)))
+               for perm in perms]
+    _transforms[size] = (perms, inverses, getters)
+    return _transforms[size]
+
+
+def board_size(state):
+    return int((len(state) // 2) ** 0.5)
+
+
+def transform(state, t):
+    """Apply symmetry number t to state."""
+    getters = transforms(board_size(state))[2]
+    return "".join(getters[t](state))
+
+
+def canonical(state):
+    """Canonical state and the number of the symmetry that maps state to it."""
+    getters = transforms(board_size(state))[2]
+    best = state
+    best_t = 0
+    for t in range(1, len(getters)):
+        candidate = "".join(getters[t](state))
+        if candidate < best:
+            best = candidate
+            best_t = t
+    return best, best_t
+
+
+def canonical_key(encode, state):
+    """Encoded key of the canonical form of state."""
+    return encode(canonical(state)[0])
+
+
+def inverse(t, size=5):
+    """Number of the symmetry undoing symmetry t."""
+    return transforms(size)[1][t]
+
+
+def transform_options(options, t):
+    """Apply symmetry number t to the states of (state, winner) options."""
+    if not t:
+        return options
+    return [(transform(state, t), winner) for state, winner in options]
@@ -0,0 +1,180 @@
+import threading
+import time
+
+import pymongo
+import pytest
+
+import mongo_serialize
+
+
+class FakeCollection(object):
+    """The part of a pymongo collection BulkMongoTree uses, in a dict.
+
+    bulk_write waits for the gate, when set, and fails as queued in fail:
+    an exception applies no operation, an index applies the operations
+    before it and raises a BulkWriteError.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.writes = []
+        self.gate = None
+        self.fail = []
+
+    def find_one(self, query):
+        doc = self.docs.get(query["_id"])
+        return dict(doc) if doc else None
+
+    def find(self, query=None):
+        if query is None:
+            keys = list(self.docs)
+        else:
+            keys = query["_id"]["$in"]
+        return [dict(self.docs[key]) for key in keys if key in self.docs]
+
+    def bulk_write(self, operations, ordered=True):
+        if self.gate:
+            self.gate.wait()
+        self.writes.append(len(operations))
+        index = len(operations)
+        error = self.fail.pop(0) if self.fail else None
+        if isinstance(error, Exception):
+            index = 0
+        elif error is not None:
+            index, error = error, pymongo.errors.BulkWriteError(
+                {"writeErrors": [{"index": error, "code": 1,
+                                  "errmsg": "failed"}]})
+        for operation in operations[:index]:
+            doc = self.docs.setdefault(
+                operation._filter["_id"],
+                {"_id": operation._filter["_id"], "tries": 0, "wins": 0,
+                 "options": []})
+            for name, value in operation._doc["$inc"].items():
+                doc[name] += value
+            doc.update(operation._doc.get("$set", {}))
+        if error:
+            raise error
+
+
+@pytest.fixture
+def collection():
+    return FakeCollection()
+
+
+def bulk_tree(collection, **kwargs):
+    tree = mongo_serialize.BulkMongoTree(**kwargs)
+    tree.tree = collection
+    return tree
+
+
+def stored(collection, state):
+    return collection.docs[state]["tries"], collection.docs[state]["wins"]
+
+
+def test_flush_states(collection):
+    tree = bulk_tree(collection, flush_states=3)
+    for state in ("a", "b"):
+        tree.merge(state, 2, 1)
+    assert not tree.flush_thread
+    tree.merge("c", 2, 1)
+    tree.flush_queue.join()
+    assert collection.writes == [3]
+    assert stored(collection, "c") == (2, 1)
+    assert not tree.updates
+    assert tree["c"]["tries"] == 2
+    tree.__exit__(None, None, None)
+    assert tree.flush_stats["flushes"] == 1
+    assert tree.flush_stats["states"] == 3
+
+
+def test_flush_seconds(collection):
+    tree = bulk_tree(collection, flush_seconds=0.01)
+    tree.merge("a", 1, 0)
+    time.sleep(0.02)
+    tree.merge("b", 1, 0)
+    tree.flush_queue.join()
+    assert collection.writes == [2]
+    tree.__exit__(None, None, None)
+
+
+def test_read_waits_for_queued_flush(collection):
+    collection.gate = threading.Event()
+    tree = bulk_tree(collection, flush_states=1, max_states=1)
+    tree.merge("a", 3, 1)
+    tree.merge("b", 1, 0)  # evicts a while its flush is queued
+    assert "a" not in tree.dict
+    threading.Timer(0.05, collection.gate.set).start()
+    assert tree["a"]["tries"] == 3
+    tree.__exit__(None, None, None)
+    assert stored(collection, "a") == (3, 1)
+
+
+def test_evict_pending_while_queued(collection):
+    collection.gate = threading.Event()
+    tree = bulk_tree(collection, flush_states=2)
+    tree.merge("a", 1, 1)
+    tree.merge("b", 1, 0)
+    tree.merge("a", 2, 0)
+    tree.write(["a"])
+    assert tree.queue_depth == 2
+    collection.gate.set()
+    assert tree["a"]["tries"] == 3
+    assert tree["a"]["wins"] == 1
+    tree.__exit__(None, None, None)
+    assert stored(collection, "a") == (3, 1)
+
+
+def test_failed_flush_is_raised_and_buffered_again(collection):
+    collection.fail = [1]
+    tree = bulk_tree(collection, flush_states=3)
+    for state in ("a", "b", "c"):
+        tree.merge(state, 2, 1)
+    tree.flush_queue.join()
+    assert stored(collection, "a") == (2, 1)
+    assert "b" not in collection.docs
+    with pytest.raises(pymongo.errors.BulkWriteError):
+        tree.flush()
+    assert tree.updates["b"] == {"tries": 2, "wins": 1}
+    assert "a" not in tree.updates
+    tree.write(["b"])
+    assert tree["b"]["tries"] == 2
+    tree.__exit__(None, None, None)
+    for state in ("a", "b", "c"):
+        assert stored(collection, state) == (2, 1)
+
+
+def test_unordered_failed_flush_buffers_only_errors(collection):
+    collection.fail = [0]
+    tree = bulk_tree(collection, flush_states=2, ordered=False)
+    tree.merge("a", 1, 0)
+    tree.merge("b", 1, 0)
+    tree.flush_queue.join()
+    with pytest.raises(pymongo.errors.BulkWriteError):
+        tree.flush()
+    assert list(tree.updates) == ["a"]
+
+
+def test_failed_read_back_raises(collection):
+    collection.fail = [ConnectionError("down")]
+    collection.gate = threading.Event()
+    tree = bulk_tree(collection, flush_states=1, max_states=1)
+    tree.merge("a", 1, 0)
+    tree.merge("b", 1, 0)
+    collection.gate.set()
+    with pytest.raises(ConnectionError):
+        tree["a"]
+    assert tree["a"]["tries"] == 1
+    tree.__exit__(None, None, None)
+    assert stored(collection, "a") == (1, 0)
+
+
+def test_failed_write_without_flush_thread(collection):
+    collection.fail = [ConnectionError("down")]
+    tree = bulk_tree(collection)
+    tree.merge("a", 2, 1)
+    with pytest.raises(ConnectionError):
+        tree.write()
+    assert tree.updates["a"] == {"tries": 2, "wins": 1}
+    assert tree["a"]["tries"] == 2
+    tree.__exit__(None, None, None)
+    assert stored(collection, "a") == (2, 1)
@@ -0,0 +1,98 @@
+"""Zobrist hashing of game states.
+
+Every (space, level) and (space, occupant) pair gets a fixed random 63 bit
+number and a state hashes to the xor of the numbers of its spaces. Occupants
+are numbered relative to the active player like in compact states, so a game
+can update the hash of a position with a few xors per move and build and the
+hash of a state string equals the hash kept by the game. Tables are seeded by
+board size and number of players so hashes are stable between processes.
+"""
+import collections
+import functools
+import operator
+import random
+
+
+LEVELS = 5
+HASH_BITS = 63
+VERIFY_STATES = 1 << 20  # states a StateVerifier remembers
+
+_tables = {}
+
+
+def tables(size, num_players=2):
+    """Random numbers per space for each level and each relative occupant.
+
+    Level 0 and the empty occupant hash to 0, so the empty board hashes to 0.
+    """
+    try:
+        return _tables[size, num_players]
+    except KeyError:
+        pass
+    rng = random.Random("zobrist-{:d}-{:d}".format(size, num_players))
+    levels = []
+    occupants = []
+    for _ in range(size**2):
+        levels.append([0] + [rng.getrandbits(HASH_BITS) for _ in range(LEVELS - 1)])
+        occupants.append([0] + [rng.getrandbits(HASH_BITS) for _ in range(num_players)])
+    _tables[size, num_players] = (levels, occupants)
+    return levels, occupants
+
+
+_pair_tables = {}
+
+
+def pair_tables(cells, num_players=2):
+    """Per space, the hash of each level and occupant digit pair."""
+    try:
+        return _pair_tables[cells, num_players]
+    except KeyError:
+        pass
+    levels, occupants = tables(int(cells ** 0.5), num_players)
+    pairs = []
+    for cell in range(cells):
+        pairs.append({str(level) + str(occupant):
+                      levels[cell][level] ^ occupants[cell][occupant]
+                      for level in range(LEVELS)
+                      for occupant in range(num_players + 1)})
+    _pair_tables[cells, num_players] = pairs
+    return pairs
+
+
+def hash_state(state, num_players=2):
+    """Hash of a compact state string."""
+    i = len(state) // 2
+    pairs = pair_tables(i, num_players)
+    return functools.reduce(operator.xor, map(dict.__getitem__, pairs,
+                                              map(str.__add__, state[:i], state[i:])))
+
+
+class HashCollisionError(Exception):
+    pass
+
+
+class StateVerifier(object):
+    """Hash states and check that no two states share a hash.
+
+    A debugging aid: only collisions among the maxsize most recently hashed
+    states of this process are found, and only those states decode.
+    """
+
+    def __init__(self, num_players=2, maxsize=VERIFY_STATES):
+        self.num_players = num_players
+        self.maxsize = maxsize
+        self.states = collections.OrderedDict()
+
+    def __call__(self, state):
+        h = hash_state(state, self.num_players)
+        try:
+            known = self.states[h]
+        except KeyError:
+            self.states[h] = state
+            if len(self.states) > self.maxsize:
+                self.states.popitem(last=False)
+            return h
+        if known != state:
+            raise HashCollisionError("{:s} and {:s}".format(known, state))
+        self.states.move_to_end(h)
+        return h